@@ -7,27 +7,29 @@ import asyncio
 import mattermost.ws
 from pprint import pprint
 import mautrix.errors
-from mautrix.types import TextMessageEventContent, MessageType, PresenceState, MessageEvent, ReactionEvent, RedactionEvent, StateEvent, EventType, MediaMessageEventContent
+from mautrix.types import TextMessageEventContent, MessageType, PresenceState, MessageEvent, ReactionEvent, RedactionEvent, StateEvent, EventType, MediaMessageEventContent, Membership
 from mautrix.appservice import AppService
 
-from util import config, is_bridged_user, matrix_to_mattermost_channel, get_mattermost_fake_user, pin_mattermost_message, unpin_mattermost_message
+from util import config, is_bridged_user, matrix_to_mattermost_channel, get_mattermost_fake_user, pin_mattermost_message, unpin_mattermost_message, remember_member_profile, forget_member_profile
 
 # naming/organization is unfortunate since we didn't plan for a bridge at the start
 from import_to_matrix.import_message import import_message, get_emoji_name
 from import_to_matrix.import_channel import get_mattermost_channel, create_channel
-from import_to_matrix.import_user import import_user, import_user_from_json
+from import_to_matrix.import_user import import_user, import_user_from_json, invalidate_user
 from import_to_matrix.matrix import get_app_service, room_exists
-from import_to_matrix.not_in_mautrix import remove_reaction
-from import_to_matrix.message_state import MessageState
-from export_from_mattermost.login import mm, own_id
+from import_to_matrix.not_in_mautrix import remove_reaction, pin_message, remember_pinned_events, update_membership
+from import_to_matrix.message_state import AsyncMessageState
+from import_to_matrix.room_mapping import get_room_for_channel
+from export_from_mattermost.login import mm, own_account, own_id
+from export_from_mattermost.async_api import mm_async
 from export_from_mattermost.mattermost_event import MattermostEvent
 
 import logging
 if config.debug:
     logging.basicConfig(level=1)
 
-bot_user = mm.get_user()
-state = MessageState()
+bot_user = own_account
+state = AsyncMessageState()
 
 async def on_mattermost_message(e: MattermostEvent) -> None:
     app_service = get_app_service()
@@ -36,11 +38,14 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
     channel_id = e.broadcast['channel_id']
     if channel_id in config.mattermost.skip_channels:
         return
-    channel = get_mattermost_channel(channel_id) if channel_id else None
+    channel = await get_mattermost_channel(channel_id) if channel_id else None
     room_id = None
     if channel:
         # Not all events are associated with a channel
-        room_id, _ = await create_channel(channel_id)
+        # (and the room only needs to be created the first time)
+        room_id = get_room_for_channel(channel_id)
+        if not room_id:
+            room_id, _ = await create_channel(channel_id)
 
     # Ignore own messages/events
     user_id = e.get_mattermost_user_id()
@@ -61,10 +66,10 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
         and channel_id not in config.mattermost.bridge.ignore_users_whitelist:
         return
 
-    user = e.get_mattermost_user()
+    user = await e.get_mattermost_user()
     user_mxid, user_api = None, None
     if user:
-        user_mxid = await import_user_from_json(user)
+        user_mxid = await import_user(user['id'])
         user_api = app_service.intent(user_mxid)
 
     match e.event:
@@ -81,7 +86,7 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
             )
         case 'post_deleted':
             message = json.loads(e.data['post'])
-            event_ids = state.get_matrix_full_event_list(message['id'])
+            event_ids = await state.get_matrix_full_event_list(message['id'])
             for event_id in event_ids:
                 await user_api.redact(room_id, event_id)            
         case 'post_edited':
@@ -90,7 +95,7 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
             # people may edit the override_username prop in the worst of cases,
             # which isn't bridgeable into a different ghost.
             message = json.loads(e.data['post'])
-            original_event_id = state.get_matrix_text_event(message['id'])
+            original_event_id = await state.get_matrix_text_event(message['id'])
             if original_event_id:
                 content = TextMessageEventContent(
                     msgtype=MessageType.TEXT,
@@ -101,11 +106,11 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
                 # Because the spec says that you cannot edit an edit, we do not store the event ID
                 if message['is_pinned']:
                     # Unimportant bug: pinned messages will show as edited no matter what
-                    await user_api.pin_message(room_id, event_id)
+                    await pin_message(user_api, room_id, event_id)
         case 'reaction_added':
             try:
                 post_id, emoji = e.get_reaction()
-                event_id = state.get_matrix_event(post_id)
+                event_id = await state.get_matrix_event(post_id)
                 await user_api.react(room_id, event_id, emoji)
             except mautrix.errors.MatrixUnknownRequestError as error:
                 if error.errcode == 'M_DUPLICATE_ANNOTATION':
@@ -115,7 +120,7 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
                     raise error
         case 'reaction_removed':
             post_id, emoji = e.get_reaction()
-            event_id = state.get_matrix_event(post_id)
+            event_id = await state.get_matrix_event(post_id)
             await remove_reaction(user_api, room_id, event_id, emoji)
         case 'typing':
             print(f"{user['username']} is typing on {channel['name']}")
@@ -143,6 +148,7 @@ async def on_mattermost_message(e: MattermostEvent) -> None:
 
             # TODO: my setup assumes people do not change their username.
             # Test what happens if someone does change their username.
+            invalidate_user(e.data['user']['id'])
             await import_user_from_json(e.data['user'])
         case _:
             print(f"Ignoring unknown event type {e.event}")
@@ -177,8 +183,8 @@ async def on_matrix_message(evt: MessageEvent, channel_id: str) -> None:
         # deal with edits
         edited_event_id = evt.content.get_edit()
         if edited_event_id:
-            mm.patch_post(
-                state.get_mattermost_event(edited_event_id),
+            await mm_async.patch_post(
+                await state.get_mattermost_event(edited_event_id),
                 message
             )
             # do we need to update the db?
@@ -189,33 +195,46 @@ async def on_matrix_message(evt: MessageEvent, channel_id: str) -> None:
         # deal with threads
         matrix_thread_parent = evt.content.get_thread_parent()
         if matrix_thread_parent:
-            mattermost_thread_parent = state.get_mattermost_event(matrix_thread_parent)
-            post = mm.create_post(channel_id, message, props, root_id=mattermost_thread_parent)
+            mattermost_thread_parent = await state.get_mattermost_event(matrix_thread_parent)
+            post = await mm_async.create_post(channel_id, message, props, root_id=mattermost_thread_parent)
         else:
-            post = mm.create_post(channel_id, message, props)
-        state.remember_matrix_event(
+            post = await mm_async.create_post(channel_id, message, props)
+        await state.remember_matrix_event(
             mattermost_id=post['id'],
             matrix_id=evt.event_id,
+            room_id=evt.room_id,
+            role='media' if isinstance(evt.content, MediaMessageEventContent) else 'text',
         )
 
 
 async def on_matrix_state_event(evt: StateEvent, channel_id):
     if evt.type == EventType.ROOM_MEMBER:
         # no need to join ghost users on the other side, since it's just a webhook
-        pass
+        # but we do keep track of how to impersonate them
+        if evt.content.membership == Membership.JOIN:
+            remember_member_profile(
+                app_service_listener.intent,
+                evt.room_id,
+                evt.state_key,
+                evt.content.displayname,
+                evt.content.avatar_url,
+            )
+        else:
+            forget_member_profile(evt.room_id, evt.state_key)
     elif evt.type == EventType.ROOM_PINNED_EVENTS:
         # TODO: not done implementing pins and unpins from either side
         # it is buggy still
         newly_pinned = set(evt.content.pinned) - set(evt.prev_content.pinned)
         newly_unpinned = set(evt.prev_content.pinned) - set(evt.content.pinned)
+        remember_pinned_events(evt.room_id, evt.content.pinned)
         # Bridge pins
         for event_id in newly_pinned:
-            post_id = state.get_mattermost_event(event_id)
-            pin_mattermost_message(mm, post_id)
+            post_id = await state.get_mattermost_event(event_id)
+            await pin_mattermost_message(mm_async, post_id)
         # Bridge unpins
         for event_id in newly_unpinned:
-            post_id = state.get_mattermost_event(event_id)
-            unpin_mattermost_message(mm, post_id)
+            post_id = await state.get_mattermost_event(event_id)
+            await unpin_mattermost_message(mm_async, post_id)
 
 
 async def on_matrix_reaction(evt: ReactionEvent, channel_id):
@@ -230,12 +249,12 @@ async def on_matrix_reaction(evt: ReactionEvent, channel_id):
         emoji = evt.content.relates_to.key
         
         matrix_message = evt.content.relates_to.event_id
-        post_id = state.get_mattermost_event(matrix_message)
+        post_id = await state.get_mattermost_event(matrix_message)
 
         emoji_name = get_emoji_name(emoji)
         if emoji_name:
             # Only react on Mattermost if there is an equivalent Mattermost reaction
-            mm.create_reaction(own_id, post_id, get_emoji_name(emoji))
+            await mm_async.create_reaction(own_id, post_id, get_emoji_name(emoji))
         else:
             print("Warning: could not find an equivalent reaction to", emoji)
 
@@ -243,8 +262,8 @@ async def on_matrix_reaction(evt: ReactionEvent, channel_id):
 async def on_matrix_deletion(evt: RedactionEvent, channel_id):
     if evt.type == EventType.ROOM_REDACTION:
         redacted_id = evt.redacts
-        mattermost_post = state.get_mattermost_event(redacted_id)
-        mm.delete_post(mattermost_post)
+        mattermost_post = await state.get_mattermost_event(redacted_id)
+        await mm_async.delete_post(mattermost_post)
 
 
 async def on_matrix_event(evt: StateEvent):
@@ -253,6 +272,10 @@ async def on_matrix_event(evt: StateEvent):
     (checking that it is not ours, and getting the mattermost ID)
     """
     print(evt)
+
+    # Our ghosts may be kicked (or leave) too, and we need to know so they rejoin
+    if evt.type == EventType.ROOM_MEMBER:
+        update_membership(evt.room_id, evt.state_key, evt.content.membership)
     
     # First, ignore our own messages
     if is_bridged_user(evt.sender):
@@ -266,7 +289,7 @@ async def on_matrix_event(evt: StateEvent):
             return
     
     api = app_service_listener.intent
-    channel_id = await matrix_to_mattermost_channel(mm, api, evt.room_id)
+    channel_id = await matrix_to_mattermost_channel(mm_async, api, evt.room_id)
     
     if not channel_id:
         print("Ignoring unknown room", evt.room_id)
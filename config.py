@@ -44,10 +44,35 @@ class MatrixConfig:
     # Whether to skip already existing rooms when importing
     skip_existing: Optional[bool] = True
 
+    # Whether to pick up imports from the last imported message of each channel,
+    # to resume interrupted imports or to import new messages into existing rooms
+    # (this takes precedence over skip_existing for rooms we have imported into)
+    resume_imports: Optional[bool] = True
+
     # Display name "template". {name} will be replaced with display name,
     # and {platform} with Mattermost or Zephyr accordingly
     display_name_format: Optional[str] = "{name} - {platform}"
 
+    # How many channels to import at once
+    import_workers: Optional[int] = 4
+
+    # How many messages ahead of the one being sent to prepare while importing
+    # (creating ghosts, uploading files...). 0 disables this
+    import_prefetch: Optional[int] = 8
+
+    # For how many seconds to trust what we know about a Mattermost user and its
+    # ghost (display name, avatar) before checking it again
+    user_cache_ttl: Optional[int] = 3600
+
+    # The database (db.sqlite) is committed once this many writes are pending,
+    # or this many milliseconds after the first pending write
+    db_commit_every: Optional[int] = 100
+    db_commit_interval_ms: Optional[int] = 500
+
+    # How many recent lookups of the event mapping (Matrix event <-> Mattermost post)
+    # to keep in memory
+    state_cache_size: Optional[int] = 10000
+
 
 @dataclass_json
 @dataclass
@@ -99,6 +124,16 @@ class MattermostConfig:
     # Channel IDs to skip exporting
     skip_channels: tuple[str] = ()
 
+    # How many channels to export at once
+    export_workers: int = 4
+
+    # Maximum number of requests per second to send to Mattermost while exporting,
+    # shared across all workers. Leave unset to not limit the request rate
+    export_rate_limit: Optional[float] = None
+
+    # How many media files to download at once
+    media_workers: int = 8
+
     # List of channels to always thread, regardless of the above options
     always_thread: Optional[tuple[str]] = ()
 
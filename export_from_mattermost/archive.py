@@ -0,0 +1,326 @@
+"""
+Reads and writes the exported messages of each channel.
+
+Each channel is a directory `downloaded/messages/<channel ID>/` with zstd-compressed
+NDJSON segments (one post per line, in chronological order) and a small
+`manifest.json` listing them. There are two kinds of segments:
+
+* "posts" segments contain new posts, appended as the channel grows
+* "updates" segments contain newer versions of posts that were already saved
+  (edits, or deletions if `delete_at` is set), which win over the original
+
+So updating a channel only ever adds a segment, and readers can stream the
+channel instead of loading all of it.
+
+Channels exported by older versions are a single JSON array in reverse chronological
+order (`downloaded/messages/<channel ID>.json`). They can still be read, and can be
+converted with `convert_legacy` (see convert_messages.py).
+"""
+
+import io
+import json
+import os
+import sys
+from array import array
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zstandard
+
+from export_from_mattermost.files import atomic_open
+
+MESSAGES_DIR = '../downloaded/messages'
+
+# How many posts to store in each segment
+SEGMENT_SIZE = 10000
+
+# Compression level for zstd, which is a good tradeoff for JSON
+COMPRESSION_LEVEL = 10
+
+# Rough size of a post in the old format, to estimate how many posts
+# a channel has without reading it
+LEGACY_BYTES_PER_POST = 800
+
+def channel_dir(channel_id):
+    return f'{MESSAGES_DIR}/{channel_id}'
+
+
+def legacy_filename(channel_id):
+    return f'{MESSAGES_DIR}/{channel_id}.json'
+
+
+def manifest_filename(channel_id):
+    return f'{channel_dir(channel_id)}/manifest.json'
+
+
+def is_legacy(channel_id):
+    """
+    Whether the channel is only stored in the old single-JSON-file format
+    """
+    return not os.path.exists(manifest_filename(channel_id)) \
+        and os.path.exists(legacy_filename(channel_id))
+
+
+def exists(channel_id):
+    """
+    Whether the channel has been exported (in either format)
+    """
+    return os.path.exists(manifest_filename(channel_id)) \
+        or os.path.exists(legacy_filename(channel_id))
+
+
+def list_channels():
+    """
+    Get the IDs of all exported channels (in either format)
+    """
+    channel_ids = set()
+    for filename in os.listdir(MESSAGES_DIR):
+        if filename.endswith('.json'):
+            channel_ids.add(filename.removesuffix('.json'))
+        elif os.path.exists(manifest_filename(filename)):
+            channel_ids.add(filename)
+    return sorted(channel_ids)
+
+
+def read_manifest(channel_id) -> dict:
+    """
+    Get the manifest of the given channel, or an empty one if it has not been
+    exported in the new format
+    """
+    filename = manifest_filename(channel_id)
+    if not os.path.exists(filename):
+        return {'segments': [], 'next_segment': 0}
+    return json.load(open(filename, 'r'))
+
+
+def _write_manifest(channel_id, manifest):
+    os.makedirs(channel_dir(channel_id), exist_ok=True)
+    with atomic_open(manifest_filename(channel_id)) as f:
+        json.dump(manifest, f, indent=2)
+
+
+def _read_segment(channel_id, segment):
+    """
+    Stream the posts in the given segment
+    """
+    with open(f"{channel_dir(channel_id)}/{segment['file']}", 'rb') as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        for line in io.TextIOWrapper(reader, encoding='utf-8'):
+            if line.strip():
+                yield json.loads(line)
+
+
+def _write_segment(channel_id, manifest, posts, kind):
+    """
+    Write the given posts as a new segment, and add it to the (in-memory) manifest
+    """
+    number = manifest['next_segment']
+    manifest['next_segment'] += 1
+    segment = {
+        'file': f'{number:05}.ndjson.zst',
+        'kind': kind,
+        'count': len(posts),
+        'first_create_at': posts[0]['create_at'],
+        'last_create_at': posts[-1]['create_at'],
+    }
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compressobj()
+    with atomic_open(f"{channel_dir(channel_id)}/{segment['file']}", 'wb') as f:
+        for post in posts:
+            f.write(compressor.compress(json.dumps(post).encode() + b'\n'))
+        f.write(compressor.flush())
+    manifest['segments'].append(segment)
+
+
+def _write_segments(channel_id, manifest, posts, kind):
+    """
+    Write the given posts (any iterable) into as many segments as needed
+    """
+    os.makedirs(channel_dir(channel_id), exist_ok=True)
+    chunk = []
+    for post in posts:
+        chunk.append(post)
+        if len(chunk) == SEGMENT_SIZE:
+            _write_segment(channel_id, manifest, chunk, kind)
+            chunk = []
+    if chunk:
+        _write_segment(channel_id, manifest, chunk, kind)
+
+
+# How much of an old JSON file to read at a time
+LEGACY_CHUNK_SIZE = 1024 * 1024
+
+def _scan_json_array(f):
+    """
+    Find where each element of the JSON array in the given binary file starts and
+    ends (as byte offsets), reading it piece by piece and parsing one element at a time
+    """
+    decoder = json.JSONDecoder()
+    # latin-1 maps every byte to one character, so string positions are byte offsets
+    # (UTF-8 characters are mangled, but they can't be confused with JSON syntax)
+    buffer = ''
+    # Offset in the file of the start of the buffer
+    buffer_offset = 0
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, buffer_offset, position, eof
+        chunk = f.read(LEGACY_CHUNK_SIZE)
+        eof = not chunk
+        # Drop what we already parsed
+        buffer = buffer[position:] + chunk.decode('latin-1')
+        buffer_offset += position
+        position = 0
+
+    def skip(characters):
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            read_more()
+
+    skip(' \t\r\n')
+    assert buffer[position] == '[', 'Expected a JSON array'
+    position += 1
+    while True:
+        skip(' \t\r\n,')
+        if buffer[position] == ']':
+            return
+        try:
+            _, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The element continues in the next chunk
+            read_more()
+            continue
+        yield buffer_offset + position, buffer_offset + end
+        position = end
+
+
+def _read_legacy(channel_id):
+    """
+    Stream the posts of a channel in the old format in chronological order, without
+    ever holding the whole file in memory (only where each post is in the file)
+    """
+    with open(legacy_filename(channel_id), 'rb') as f:
+        starts = array('q')
+        ends = array('q')
+        for start, end in _scan_json_array(f):
+            starts.append(start)
+            ends.append(end)
+        # Reverse cause reverse chronological order
+        for start, end in zip(reversed(starts), reversed(ends)):
+            f.seek(start)
+            yield json.loads(f.read(end - start))
+
+
+def count_messages(channel_id):
+    """
+    Get the number of posts in the channel. For the new format, this comes from the
+    manifest, and is an upper bound since it counts deleted posts.
+    """
+    if is_legacy(channel_id):
+        with open(legacy_filename(channel_id), 'rb') as f:
+            return sum(1 for _ in _scan_json_array(f))
+    manifest = read_manifest(channel_id)
+    return sum(segment['count'] for segment in manifest['segments'] if segment['kind'] == 'posts')
+
+
+def estimate_messages(channel_id):
+    """
+    Get about how many posts the channel has, without reading it: the same as
+    `count_messages` for the new format, and an estimate from the file size for
+    the old format
+    """
+    if is_legacy(channel_id):
+        return os.path.getsize(legacy_filename(channel_id)) // LEGACY_BYTES_PER_POST
+    return count_messages(channel_id)
+
+
+def count_updates(channel_id):
+    """
+    Get the number of edits and deletions stored separately from the posts they apply to
+    """
+    manifest = read_manifest(channel_id)
+    return sum(segment['count'] for segment in manifest['segments'] if segment['kind'] == 'updates')
+
+
+def last_create_at(channel_id):
+    """
+    Get the creation time of the newest post in the channel, or 0 if there are none
+    """
+    manifest = read_manifest(channel_id)
+    return max(
+        (segment['last_create_at'] for segment in manifest['segments'] if segment['kind'] == 'posts'),
+        default=0,
+    )
+
+
+def read_messages(channel_id):
+    """
+    Stream the posts of the channel in chronological order, with edits applied
+    and deleted posts left out
+    """
+    if is_legacy(channel_id):
+        yield from _read_legacy(channel_id)
+        return
+
+    manifest = read_manifest(channel_id)
+    # Updates are only a small fraction of the channel, so they fit in memory
+    updates = {}
+    for segment in manifest['segments']:
+        if segment['kind'] == 'updates':
+            for post in _read_segment(channel_id, segment):
+                updates[post['id']] = post
+    for segment in manifest['segments']:
+        if segment['kind'] == 'posts':
+            for post in _read_segment(channel_id, segment):
+                post = updates.get(post['id'], post)
+                if not post['delete_at']:
+                    yield post
+
+
+def append_messages(channel_id, posts, kind='posts'):
+    """
+    Add a segment with the given posts (in chronological order) to the channel.
+    `kind` is 'posts' for new posts or 'updates' for new versions of saved posts.
+    """
+    if not posts:
+        return
+    manifest = read_manifest(channel_id)
+    _write_segments(channel_id, manifest, posts, kind)
+    # The segments are not part of the channel until the manifest says so
+    _write_manifest(channel_id, manifest)
+
+
+def write_messages(channel_id, posts):
+    """
+    Replace the whole channel with the given posts (any iterable, in chronological
+    order). The posts may be streamed from this same channel, since the old segments
+    are only removed at the end.
+    """
+    old_manifest = read_manifest(channel_id)
+    manifest = {'segments': [], 'next_segment': old_manifest['next_segment']}
+    _write_segments(channel_id, manifest, posts, 'posts')
+    _write_manifest(channel_id, manifest)
+    for segment in old_manifest['segments']:
+        os.remove(f"{channel_dir(channel_id)}/{segment['file']}")
+    if os.path.exists(legacy_filename(channel_id)):
+        os.remove(legacy_filename(channel_id))
+
+
+def compact(channel_id):
+    """
+    Fold all edits and deletions into the posts, so that reading the channel
+    does not need to keep them in memory
+    """
+    write_messages(channel_id, read_messages(channel_id))
+
+
+def convert_legacy(channel_id):
+    """
+    Convert a channel from the old single-JSON-file format into the new format
+    """
+    write_messages(channel_id, read_messages(channel_id))
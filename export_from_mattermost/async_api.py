@@ -0,0 +1,163 @@
+"""
+asyncio version of the parts of the Mattermost API that the bridge and the importer use,
+so that waiting for Mattermost does not block everything else (the synchronous
+`mattermost.MMApi` is still used by the export scripts).
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from mattermost import MMApi
+
+from export_from_mattermost.login import mm, config
+from export_from_mattermost.files import atomic_open
+from export_from_mattermost.media import CHUNK_SIZE, DOWNLOAD_ATTEMPTS, RETRY_DELAY
+
+# How many connections to Mattermost to keep open at most
+CONNECTION_LIMIT = 16
+
+def _is_retryable(error: aiohttp.ClientError):
+    """
+    Whether it is worth trying again after the given error
+    (connection problems, server errors or rate limits, but not e.g. 404s)
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+class AsyncMMApi:
+    """
+    Non-blocking Mattermost client, logged in as the given `MMApi`.
+
+    All requests share one session, so connections are pooled and kept alive.
+    """
+
+    _session: aiohttp.ClientSession | None
+
+    def __init__(self, mm_api: MMApi):
+        self._url = mm_api._url
+        self._headers = mm_api._headers
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session has to be created from within the event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=CONNECTION_LIMIT),
+                headers=self._headers,
+                raise_for_status=True,
+            )
+        return self._session
+
+    async def close(self):
+        """
+        Closes all connections to Mattermost
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method, endpoint, params=None, json=None):
+        """
+        Makes a request to the given API endpoint, and returns the JSON response
+        (or None if there is none)
+        """
+        async with self._get_session().request(method, self._url + endpoint, params=params, json=json) as response:
+            if response.content_type != 'application/json':
+                return None
+            return await response.json()
+
+    async def _get_bytes(self, endpoint) -> bytes:
+        async with self._get_session().get(self._url + endpoint) as response:
+            return await response.read()
+
+    async def get_user(self, user_id='me') -> dict:
+        return await self._request('GET', f'/v4/users/{user_id}')
+
+    async def get_user_image(self, user_id) -> bytes:
+        """
+        Gets the profile picture for the given user ID, as bytes
+        """
+        return await self._get_bytes(f'/v4/users/{user_id}/image')
+
+    async def get_teams(self) -> list[dict]:
+        teams = []
+        page = 0
+        while chunk := await self._request('GET', '/v4/teams', params={'page': page, 'per_page': 200}):
+            teams.extend(chunk)
+            page += 1
+        return teams
+
+    async def get_channel(self, channel_id) -> dict:
+        return await self._request('GET', f'/v4/channels/{channel_id}')
+
+    async def get_channel_by_name(self, team_id, channel_name) -> dict:
+        return await self._request('GET', f'/v4/teams/{team_id}/channels/name/{channel_name}')
+
+    async def create_post(self, channel_id, message, props=None, root_id=None) -> dict:
+        post = {'channel_id': channel_id, 'message': message}
+        if props:
+            post['props'] = props
+        if root_id:
+            post['root_id'] = root_id
+        return await self._request('POST', '/v4/posts', json=post)
+
+    async def patch_post(self, post_id, message=None, is_pinned=None, props=None) -> dict:
+        patch = {}
+        if message is not None:
+            patch['message'] = message
+        if is_pinned is not None:
+            patch['is_pinned'] = is_pinned
+        if props is not None:
+            patch['props'] = props
+        return await self._request('PUT', f'/v4/posts/{post_id}/patch', json=patch)
+
+    async def delete_post(self, post_id):
+        return await self._request('DELETE', f'/v4/posts/{post_id}')
+
+    async def create_reaction(self, user_id, post_id, emoji_name) -> dict:
+        return await self._request('POST', '/v4/reactions', json={
+            'user_id': user_id,
+            'post_id': post_id,
+            'emoji_name': emoji_name,
+        })
+
+    async def pin_post(self, post_id):
+        return await self._request('POST', f'/v4/posts/{post_id}/pin')
+
+    async def unpin_post(self, post_id):
+        return await self._request('POST', f'/v4/posts/{post_id}/unpin')
+
+    async def download_to_file(self, endpoint, filename) -> str:
+        """
+        Async version of `media.download_to_file`: streams the given API endpoint into
+        a file (which only appears once it is complete), retrying with exponential
+        backoff, and returns the SHA-256 of the contents (as a hex string).
+        """
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            try:
+                async with self._get_session().get(self._url + endpoint) as response:
+                    contents_hash = hashlib.sha256()
+                    with atomic_open(filename, 'wb') as f:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            await asyncio.to_thread(f.write, chunk)
+                            contents_hash.update(chunk)
+                    return contents_hash.hexdigest()
+            except aiohttp.ClientError as e:
+                if attempt == DOWNLOAD_ATTEMPTS - 1 or not _is_retryable(e):
+                    raise
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+    async def download_media(self, media_id) -> str:
+        """
+        Async version of `media.download_media`
+        """
+        return await self.download_to_file(f'/v4/files/{media_id}', f'../downloaded/media/{media_id}')
+
+
+mm_async = AsyncMMApi(mm)
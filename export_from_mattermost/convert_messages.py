@@ -0,0 +1,21 @@
+"""
+Convert every channel in `downloaded/messages` exported by older versions
+(a single JSON file each) into the segmented format (see archive.py)
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export_from_mattermost import archive
+from progress.bar import Bar
+
+# change to the script's location
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+legacy_channels = [channel_id for channel_id in archive.list_channels() if archive.is_legacy(channel_id)]
+
+with Bar('Converting channels', max=len(legacy_channels)) as bar:
+    for channel_id in legacy_channels:
+        archive.convert_legacy(channel_id)
+        bar.next()
@@ -2,25 +2,72 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from export_from_mattermost.media import download_media
-import os
-import json
+from export_from_mattermost.media import download_media, config
+from export_from_mattermost import archive
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from progress.bar import Bar
+import threading
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return f'{size:.1f} {unit}'
+
+
+class DownloadBar(Bar):
+    """
+    Progress bar counting bytes, which shows the download speed
+    """
+    suffix = '%(downloaded)s / %(total)s - %(speed)s/s - ETA %(eta_td)s'
+
+    @property
+    def downloaded(self):
+        return format_bytes(self.index)
+
+    @property
+    def total(self):
+        return format_bytes(self.max)
+
+    @property
+    def speed(self):
+        return format_bytes(1 / self.avg if self.avg else 0)
+
 
 # Create subdirectory if needed
 if not os.path.exists('../downloaded/media'):
     os.mkdir('../downloaded/media')
 
-for filename in os.listdir('../downloaded/messages'):
-    # Skip non-JSON files (such as .gitignore)
-    if 'json' not in filename:
-        continue
-
-    with open(f'../downloaded/messages/{filename}') as f:
-        messages = json.load(f)
-    for message in messages:
+# Find what we are missing (files that exist are always complete)
+missing = {}
+for channel_id in archive.list_channels():
+    for message in archive.read_messages(channel_id):
         if 'files' in message['metadata']:
             for file in message['metadata']['files']:
                 media_id = file['id']
                 if not os.path.exists(f'../downloaded/media/{media_id}'):
-                    download_media(file['id'])
+                    missing[media_id] = file['size']
+
+bar_lock = threading.Lock()
+failed = 0
+
+with DownloadBar('Downloading media', max=sum(missing.values()) or 1) as bar:
+    def on_progress(size):
+        with bar_lock:
+            bar.next(size)
+
+    with ThreadPoolExecutor(max_workers=config.mattermost.media_workers) as executor:
+        futures = {
+            executor.submit(download_media, media_id, on_progress): media_id
+            for media_id in missing
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f'\nCould not download {futures[future]}: {e}', file=sys.stderr)
 
+if failed:
+    print(f'{failed} files could not be downloaded. Run this script again to retry them.', file=sys.stderr)
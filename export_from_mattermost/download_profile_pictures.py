@@ -1,14 +1,21 @@
 """
 Download all user and team profile pictures
+
+Pictures are only downloaded again if they have changed since the last run,
+according to `downloaded/pfp/manifest.json`
 """
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from export_from_mattermost.media import download_media, download_profile_picture, download_team_picture
+from export_from_mattermost.media import download_profile_picture, download_team_picture, config
+from export_from_mattermost.files import atomic_open
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import json
 
+MANIFEST_FILE = '../downloaded/pfp/manifest.json'
+
 # Create subdirectory if needed
 if not os.path.exists('../downloaded/pfp'):
     os.mkdir('../downloaded/pfp')
@@ -16,13 +23,41 @@ if not os.path.exists('../downloaded/pfp'):
 users = json.load(open('../downloaded/users.json', 'r'))
 teams = json.load(open('../downloaded/teams.json', 'r'))
 
-# TODO: this redownloads all pictures every time you run the file
-# It might be good to persist which ones have been downloaded and not been changed
+# For each user or team ID: when its picture was last changed on Mattermost
+# ('updated') and the SHA-256 of the file we have ('sha256')
+manifest = json.load(open(MANIFEST_FILE, 'r')) if os.path.exists(MANIFEST_FILE) else {}
+
+def is_up_to_date(id, updated):
+    return id in manifest \
+        and manifest[id]['updated'] == updated \
+        and os.path.exists(f'../downloaded/pfp/{id}')
+
+# (download function, ID, last update) for every picture that changed
+to_download = []
 for user in users:
-    if 'last_picture_update' in user:
-        # Otherwise the API just returns a generic profile picture
-        download_profile_picture(user['id'])
+    # Otherwise the API just returns a generic profile picture
+    if 'last_picture_update' in user and not is_up_to_date(user['id'], user['last_picture_update']):
+        to_download.append((download_profile_picture, user['id'], user['last_picture_update']))
 
 for team in teams:
-    if 'last_team_icon_update' in team:
-        download_team_picture(team['id'])
\ No newline at end of file
+    if 'last_team_icon_update' in team and not is_up_to_date(team['id'], team['last_team_icon_update']):
+        to_download.append((download_team_picture, team['id'], team['last_team_icon_update']))
+
+print(f'Downloading {len(to_download)} changed pictures')
+
+try:
+    with ThreadPoolExecutor(max_workers=config.mattermost.media_workers) as executor:
+        futures = {
+            executor.submit(download, id): (id, updated)
+            for download, id, updated in to_download
+        }
+        for future in as_completed(futures):
+            id, updated = futures[future]
+            try:
+                manifest[id] = {'updated': updated, 'sha256': future.result()}
+            except Exception as e:
+                print(f'Could not download picture for {id}: {e}', file=sys.stderr)
+finally:
+    # Save progress even if interrupted
+    with atomic_open(MANIFEST_FILE) as f:
+        json.dump(manifest, f)
@@ -3,28 +3,32 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from export_from_mattermost.export_channel import export_channel, mm, own_id, config
-import json
+from import_to_matrix.catalog import catalog
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 if not os.path.exists('../downloaded/channels.json'):
     import export_channel_list
     # No need to do anything else, we have created the file now
 
-channels = json.load(open('../downloaded/channels.json', 'r'))
-teams = json.load(open('../downloaded/teams.json', 'r'))
-
-def team_by_id(team_id):
-    for team in teams:
-        if team['id'] == team_id:
-            return team
-
-for channel in channels:
-    print('Downloading channel', channel['display_name'], 'in', team_by_id(channel['team_id'])['display_name'])
+def describe(channel):
+    return f"{channel['display_name']} in {catalog.get_team(channel['team_id'])['display_name']}"
 
+to_export = []
+for channel in catalog.channels:
     # Skip channels as per config
     if channel['id'] in config.mattermost.skip_channels:
-        print('   skipping')
+        print('Skipping channel', describe(channel))
         continue
-
-    # Download channel
-    export_channel(channel['id'])
-
+    to_export.append(channel)
+
+# Channels are independent of each other, so download several of them at once.
+# The rate limiter inside export_channel keeps the total request rate in check.
+with ThreadPoolExecutor(max_workers=config.mattermost.export_workers) as executor:
+    futures = {executor.submit(export_channel, channel['id']): channel for channel in to_export}
+    for i, future in enumerate(as_completed(futures), start=1):
+        channel = futures[future]
+        try:
+            future.result()
+            print(f'[{i}/{len(futures)}] Downloaded channel', describe(channel))
+        except Exception as e:
+            print(f'[{i}/{len(futures)}] Could not download channel {describe(channel)}: {e}', file=sys.stderr)
@@ -1,39 +1,146 @@
 from login import mm, own_id, config
-import json
+from rate_limit import limiter
+from watermarks import get_watermark, set_watermark
+import archive
 import os
 
 # Create subdirectory if needed
 if not os.path.exists('../downloaded/media'):
     os.mkdir('../downloaded/media')
 
+# Maximum allowed by Mattermost
+POSTS_PER_PAGE = 200
+
+# Mattermost silently truncates `since` queries to this many posts
+POSTS_SINCE_LIMIT = 1000
+
+def get_posts_for_channel(channel_id):
+    """
+    Same as mm.get_posts_for_channel (newest posts first), but it goes through
+    the rate limiter before asking for each page
+    """
+    page = 0
+    while True:
+        limiter.wait()
+        data = mm._get(
+            f'/v4/channels/{channel_id}/posts',
+            params={'page': page, 'per_page': POSTS_PER_PAGE},
+        )
+        if not data['order']:
+            break
+        for post_id in data['order']:
+            yield data['posts'][post_id]
+        page += 1
+
+
+def get_posts_changed_since(channel_id, since):
+    """
+    Get every post in the channel that was created, edited or deleted after `since`
+    (a timestamp in milliseconds). Returns None if there are too many changes
+    for Mattermost to return them all at once.
+    """
+    limiter.wait()
+    data = mm._get(f'/v4/channels/{channel_id}/posts', params={'since': since})
+    posts = list(data['posts'].values())
+    if len(posts) >= POSTS_SINCE_LIMIT:
+        return None
+    return posts
+
+
+def split_changed_posts(changed_posts, newest_saved):
+    """
+    Split the posts returned by `get_posts_changed_since` into posts that are new to
+    the archive, and newer versions (edits, or deletions) of posts that are already
+    saved, by comparing them to the creation time of the newest saved post.
+    Both lists are returned in chronological order.
+    """
+    new_posts = []
+    updates = []
+    for post in sorted(changed_posts, key=lambda post: post['create_at']):
+        # Old revisions of edited posts come back too, but we only want the latest
+        if post.get('original_id'):
+            continue
+        if post['create_at'] > newest_saved:
+            # (unless it was deleted before we ever saw it)
+            if not post['delete_at']:
+                new_posts.append(post)
+        else:
+            updates.append(post)
+    return new_posts, updates
+
+
+def get_latest_update(posts, default=0):
+    return max((post['update_at'] for post in posts), default=default)
+
+
 def export_channel(channel_id):
     """
-    Dump the channel by ID into a JSON file in the `messages` directory
+    Dump the channel by ID into the `messages` directory (see archive.py)
 
-    If the JSON file already exists, it updates it to add the newest messages
-    Note that edits are not reflected.
+    If the channel was already exported, it updates it instead. If the channel has been
+    exported before, only the posts that changed since then are requested, and new posts,
+    edits and deletions are appended to the archive. Otherwise (for channels exported by
+    older versions), the newest messages are added but edits are not reflected.
+
+    This is safe to call from several threads at once (for different channels).
     """
     # Join if necessary
+    limiter.wait()
     mm.add_user_to_channel(channel_id, own_id)
 
-    filename = f'../downloaded/messages/{channel_id}.json'
+    if archive.is_legacy(channel_id):
+        print("   Converting file to the new format")
+        archive.convert_legacy(channel_id)
+
+    watermark = get_watermark(channel_id)
 
-    if os.path.exists(filename):
-        print("   File already found, updating instead")
-        existing_posts = json.load(open(filename, 'r'))
-        existing_ids = {post['id'] for post in existing_posts}
+    if archive.exists(channel_id) and watermark is not None:
+        changed_posts = get_posts_changed_since(channel_id, watermark)
+        if changed_posts is None:
+            print("   Too many changes, downloading the whole channel again")
+            all_posts = [post for post in get_posts_for_channel(channel_id)]
+            archive.write_messages(channel_id, reversed(all_posts))
+            watermark = get_latest_update(all_posts, default=watermark)
+        elif not changed_posts:
+            # Nothing to do
+            return
+        else:
+            # Splitting by creation time also makes this safe to redo after a crash,
+            # since posts that were already appended now count as (identical) updates
+            new_posts, updates = split_changed_posts(changed_posts, archive.last_create_at(channel_id))
+            print(f"   Saving {len(new_posts)} new posts and {len(updates)} edits or deletions")
+            archive.append_messages(channel_id, updates, kind='updates')
+            archive.append_messages(channel_id, new_posts)
+            watermark = get_latest_update(changed_posts, default=watermark)
+            # Readers keep edits in memory, so fold them in once there are too many
+            if archive.count_updates(channel_id) > max(archive.SEGMENT_SIZE, archive.count_messages(channel_id) // 4):
+                print("   Compacting")
+                archive.compact(channel_id)
+    elif archive.exists(channel_id):
+        print("   Channel already found, updating instead")
+        existing_ids = set()
+        watermark = 0
+        for post in archive.read_messages(channel_id):
+            existing_ids.add(post['id'])
+            watermark = max(watermark, post['update_at'])
         new_posts = []
-        for post in mm.get_posts_for_channel(channel_id):
+        for post in get_posts_for_channel(channel_id):
             # Break at first old post found
             # because it means that everything beyond that has already been saved
             if post['id'] in existing_ids:
                 break
             new_posts.append(post)
-        all_posts = new_posts + existing_posts
+        # Reverse cause reverse chronological order
+        archive.append_messages(channel_id, new_posts[::-1])
+        watermark = get_latest_update(new_posts, default=watermark)
     else:
-        all_posts = [post for post in mm.get_posts_for_channel(channel_id)]
+        all_posts = [post for post in get_posts_for_channel(channel_id)]
+        # Reverse cause reverse chronological order
+        archive.write_messages(channel_id, reversed(all_posts))
+        watermark = get_latest_update(all_posts)
 
-    json.dump(all_posts, open(filename, 'w'))
+    # Only move the watermark once the posts are safely written
+    set_watermark(channel_id, watermark)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,27 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_open(filename, mode='w'):
+    """
+    Open a temporary file next to `filename`, and move it over `filename` only
+    once the `with` block finishes successfully. This way, a crash never leaves
+    a half-written file behind (the old file, if any, is kept instead).
+    """
+    directory = os.path.dirname(filename) or '.'
+    fd, temp_filename = tempfile.mkstemp(
+        dir=directory,
+        prefix=f'.{os.path.basename(filename)}.',
+        suffix='.tmp',
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
@@ -0,0 +1,295 @@
+"""
+Produce the same files as the other export scripts (teams.json, users.json,
+channels.json, messages/ and media/), but from a Mattermost bulk export
+(`mmctl export create --attachments`, then `mmctl export download`) instead of
+the REST API. Does not talk to the Mattermost server at all.
+
+Bulk exports do not contain IDs, so we make up stable ones from the names,
+which means running this twice on the same export gives the same IDs.
+Only public channels are kept, like export_channel_list.py does.
+"""
+
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from export_from_mattermost import archive
+from export_from_mattermost.files import atomic_open
+
+# How many posts to hold for each channel before writing them to its spool file
+SPOOL_BUFFER_SIZE = 1000
+
+def make_id(*parts):
+    """
+    Make up a Mattermost-looking ID (26 lowercase base32 characters)
+    that is always the same for the same parts
+    """
+    digest = hashlib.sha256('\0'.join(str(part) for part in parts).encode()).digest()
+    return base64.b32encode(digest).decode().lower()[:26]
+
+
+class BulkExport:
+    """
+    A bulk export, either as the .zip that mmctl downloads or extracted into a directory
+    """
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+        self.path = path
+
+    def names(self):
+        if self.zip:
+            return self.zip.namelist()
+        return [
+            os.path.relpath(os.path.join(root, name), self.path)
+            for root, _, names in os.walk(self.path)
+            for name in names
+        ]
+
+    def open(self, name):
+        if self.zip:
+            return self.zip.open(name)
+        return open(os.path.join(self.path, name), 'rb')
+
+    def size(self, name):
+        if self.zip:
+            return self.zip.getinfo(name).file_size
+        return os.path.getsize(os.path.join(self.path, name))
+
+    def lines(self):
+        """
+        Stream the JSON objects of the export, one per line
+        """
+        jsonl = [name for name in self.names() if name.endswith('.jsonl')]
+        assert len(jsonl) == 1, f'Expected exactly one .jsonl file in the export, found {jsonl}'
+        with self.open(jsonl[0]) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def copy_file(export: BulkExport, path, destination):
+    """
+    Copy a file out of the export, without reading it all into memory
+    """
+    if not os.path.exists(destination):
+        with export.open(path) as source, atomic_open(destination, 'wb') as f:
+            shutil.copyfileobj(source, f)
+
+
+class Ingester:
+    def __init__(self, export: BulkExport, spool_dir):
+        self.export = export
+        self.spool_dir = spool_dir
+        self.teams = {}
+        self.channels = {}
+        self.users = {}
+        # Posts per channel ID that have not been written to the spool yet
+        self.spool_buffers: dict[str, list] = {}
+        # To find attachments by their path
+        self.export_names = set(export.names())
+
+    def get_user_id(self, username):
+        """
+        Get the ID of the given username, adding a bare user if the export
+        did not list it (which is the case for some deleted users)
+        """
+        if username not in self.users:
+            self.users[username] = {
+                'id': make_id('user', username),
+                'username': username,
+                'first_name': '',
+                'last_name': '',
+                'nickname': '',
+                'delete_at': 0,
+            }
+        return self.users[username]['id']
+
+    def add_team(self, team):
+        self.teams[team['name']] = {
+            'id': make_id('team', team['name']),
+            'name': team['name'],
+            'display_name': team['display_name'],
+            'description': team.get('description') or '',
+            'type': team['type'],
+        }
+
+    def add_channel(self, channel):
+        # Only public channels, like export_channel_list.py
+        if channel['type'] != 'O':
+            return
+        team_id = make_id('team', channel['team'])
+        self.channels[(channel['team'], channel['name'])] = {
+            'id': make_id('channel', channel['team'], channel['name']),
+            'team_id': team_id,
+            'name': channel['name'],
+            'display_name': channel['display_name'],
+            'type': channel['type'],
+            'header': channel.get('header') or '',
+            'purpose': channel.get('purpose') or '',
+            'creator_id': '',
+        }
+
+    def add_user(self, user):
+        user_id = self.get_user_id(user['username'])
+        record = self.users[user['username']]
+        record |= {
+            'first_name': user.get('first_name') or '',
+            'last_name': user.get('last_name') or '',
+            'nickname': user.get('nickname') or '',
+            'email': user.get('email') or '',
+            'position': user.get('position') or '',
+        }
+        if 'delete_at' in user:
+            record['delete_at'] = user['delete_at']
+        profile_image = user.get('profile_image')
+        if profile_image and profile_image in self.export_names:
+            copy_file(self.export, profile_image, f'../downloaded/pfp/{user_id}')
+            # Only its presence matters (otherwise we'd use a generic picture)
+            record['last_picture_update'] = int(time.time() * 1000)
+
+    def convert_files(self, post_id, attachments):
+        files = []
+        for i, attachment in enumerate(attachments or []):
+            path = attachment['path']
+            if path not in self.export_names:
+                print(f'   Warning: attachment {path} is missing from the export', file=sys.stderr)
+                continue
+            file_id = make_id('file', post_id, i, path)
+            copy_file(self.export, path, f'../downloaded/media/{file_id}')
+            files.append({
+                'id': file_id,
+                'post_id': post_id,
+                'name': os.path.basename(path),
+                'mime_type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                'size': self.export.size(path),
+                # Not in the export
+                'width': None,
+                'height': None,
+            })
+        return files
+
+    def convert_post(self, post, channel_id, root_id=''):
+        """
+        Convert a post (or reply) from the bulk export into the format of the REST API
+        """
+        user_id = self.get_user_id(post['user'])
+        post_id = make_id('post', channel_id, user_id, post['create_at'], root_id, post['message'])
+        metadata = {}
+        if post.get('reactions'):
+            metadata['reactions'] = [
+                {
+                    'user_id': self.get_user_id(reaction['user']),
+                    'post_id': post_id,
+                    'emoji_name': reaction['emoji_name'],
+                    'create_at': reaction['create_at'],
+                }
+                for reaction in post['reactions']
+            ]
+        files = self.convert_files(post_id, post.get('attachments'))
+        if files:
+            metadata['files'] = files
+        return {
+            'id': post_id,
+            'create_at': post['create_at'],
+            'update_at': post.get('edit_at') or post['create_at'],
+            'edit_at': post.get('edit_at') or 0,
+            'delete_at': 0,
+            'is_pinned': post.get('is_pinned', False),
+            'user_id': user_id,
+            'channel_id': channel_id,
+            'root_id': root_id,
+            'original_id': '',
+            'message': post['message'],
+            'type': post.get('type') or '',
+            'props': post.get('props') or {},
+            'hashtags': '',
+            'pending_post_id': '',
+            'metadata': metadata,
+        }
+
+    def add_post(self, post):
+        channel = self.channels.get((post['team'], post['channel']))
+        if channel is None:
+            # Private channel
+            return
+        root = self.convert_post(post, channel['id'])
+        replies = [self.convert_post(reply, channel['id'], root_id=root['id']) for reply in post.get('replies') or []]
+        root['reply_count'] = len(replies)
+        for converted in [root] + replies:
+            buffer = self.spool_buffers.setdefault(channel['id'], [])
+            buffer.append(converted)
+            if len(buffer) >= SPOOL_BUFFER_SIZE:
+                self.flush_spool(channel['id'])
+
+    def flush_spool(self, channel_id):
+        with open(f'{self.spool_dir}/{channel_id}.ndjson', 'a') as f:
+            for post in self.spool_buffers.pop(channel_id, []):
+                f.write(json.dumps(post) + '\n')
+
+    def write_messages(self):
+        """
+        Write every channel's posts into the archive, in chronological order
+        """
+        for channel_id in list(self.spool_buffers):
+            self.flush_spool(channel_id)
+        for filename in os.listdir(self.spool_dir):
+            channel_id = filename.removesuffix('.ndjson')
+            # Only one channel is in memory at a time
+            with open(f'{self.spool_dir}/{filename}') as f:
+                posts = [json.loads(line) for line in f]
+            posts.sort(key=lambda post: post['create_at'])
+            archive.write_messages(channel_id, posts)
+            print(f'   {len(posts)} posts in channel {channel_id}')
+
+    def ingest(self):
+        counts = {}
+        for line in self.export.lines():
+            counts[line['type']] = counts.get(line['type'], 0) + 1
+            match line['type']:
+                case 'team':
+                    self.add_team(line['team'])
+                case 'channel':
+                    self.add_channel(line['channel'])
+                case 'user':
+                    self.add_user(line['user'])
+                case 'post':
+                    self.add_post(line['post'])
+                case _:
+                    # version, emoji, direct_channel, direct_post, ...
+                    pass
+        print('Read', ', '.join(f'{count} {type}' for type, count in counts.items()))
+
+        self.write_messages()
+        for name, records in (
+            ('teams', self.teams.values()),
+            ('users', self.users.values()),
+            ('channels', self.channels.values()),
+        ):
+            with atomic_open(f'../downloaded/{name}.json') as f:
+                json.dump(list(records), f)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: ingest_bulk_export.py [path to the bulk export .zip or extracted directory]", file=sys.stderr)
+        exit(1)
+    path = os.path.abspath(sys.argv[1])
+
+    # change to the script's location
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    for directory in ('../downloaded/media', '../downloaded/pfp'):
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+    with tempfile.TemporaryDirectory() as spool_dir:
+        Ingester(BulkExport(path), spool_dir).ingest()
@@ -44,14 +44,14 @@ class MattermostEvent:
             return json.loads(self.data['post'])['user_id']
 
     
-    def get_mattermost_user(self):
+    async def get_mattermost_user(self):
         """
         Gets the Mattermost user dict of the event,
         or None if not found
         """
         user_id = self.get_mattermost_user_id()
         if user_id:
-            return get_mattermost_user(user_id)
+            return await get_mattermost_user(user_id)
         
     def get_reaction(self):
         """
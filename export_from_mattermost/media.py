@@ -1,18 +1,79 @@
+import hashlib
 import os
 import sys
+import time
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from export_from_mattermost.login import mm
+import requests
 
-def download_media(media_id):
+from export_from_mattermost.login import mm, config
+from export_from_mattermost.files import atomic_open
+
+# Size of the pieces we write to disk at a time, so big files are never fully in memory
+CHUNK_SIZE = 1024 * 1024
+
+# How many times to try a download before giving up, and how long to wait
+# after the first failure (doubling every time)
+DOWNLOAD_ATTEMPTS = 5
+RETRY_DELAY = 1
+
+# Mattermost's Python package can't stream responses, so downloads use their own
+# session, which keeps connections open between downloads (one for each worker)
+_session = requests.Session()
+_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=config.mattermost.media_workers,
+    pool_maxsize=config.mattermost.media_workers,
+))
+
+def _is_retryable(error: requests.RequestException):
+    """
+    Whether it is worth trying again after the given error
+    (connection problems, server errors or rate limits, but not e.g. 404s)
+    """
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return True
+
+
+def download_to_file(endpoint, filename, on_progress=None) -> str:
+    """
+    Streams the given Mattermost API endpoint into a file, retrying with exponential
+    backoff. The file only appears once it is complete, so a file that exists is
+    always fully downloaded. Calls `on_progress` with the size of each chunk as it
+    goes (and with minus what an attempt downloaded if it fails, since the next
+    attempt starts over), and returns the SHA-256 of the contents (as a hex string).
+    """
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        downloaded = 0
+        try:
+            # TODO: contribute to Python package
+            with _session.get(mm._url + endpoint, headers=mm._headers, stream=True) as response:
+                response.raise_for_status()
+                contents_hash = hashlib.sha256()
+                with atomic_open(filename, 'wb') as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        contents_hash.update(chunk)
+                        downloaded += len(chunk)
+                        if on_progress:
+                            on_progress(len(chunk))
+                return contents_hash.hexdigest()
+        except requests.RequestException as e:
+            if on_progress and downloaded:
+                on_progress(-downloaded)
+            if attempt == DOWNLOAD_ATTEMPTS - 1 or not _is_retryable(e):
+                raise
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+
+def download_media(media_id, on_progress=None):
     """
     Dumps the desired media by ID into a file inside the `media` folder
 
     Assumes the `media` folder already exists
     """
-    response = mm.get_file(media_id)
-    with open(f'../downloaded/media/{media_id}', 'wb') as f:
-        f.write(response.content)
+    return download_to_file(f'/v4/files/{media_id}', f'../downloaded/media/{media_id}', on_progress)
 
 
 def get_profile_picture_bytes(user_id) -> bytes:
@@ -24,24 +85,21 @@ def get_profile_picture_bytes(user_id) -> bytes:
     return response.content
 
 
-def download_profile_picture(user_id):
+def download_profile_picture(user_id, on_progress=None):
     """
     Dumps the desired profile picture by user ID into a file inside the `pfp`
-    folder.
+    folder, and returns its SHA-256.
 
     Assumes the `pfp` folder already exists, and that the user has a profile picture.
     """
-    with open(f'../downloaded/pfp/{user_id}', 'wb') as f:
-        f.write(get_profile_picture_bytes(user_id))
+    return download_to_file(f'/v4/users/{user_id}/image', f'../downloaded/pfp/{user_id}', on_progress)
 
 
-def download_team_picture(team_id):
+def download_team_picture(team_id, on_progress=None):
     """
     Dumps the desired team profile picture by team ID into a file inside the `pfp`
-    folder.
+    folder, and returns its SHA-256.
 
     Assumes the `pfp` folder already exists, and that the team has a profile picture.
     """
-    response = mm._get(f'/v4/teams/{team_id}/image', raw=True)
-    with open(f'../downloaded/pfp/{team_id}', 'wb') as f:
-        f.write(response.content)
+    return download_to_file(f'/v4/teams/{team_id}/image', f'../downloaded/pfp/{team_id}', on_progress)
@@ -0,0 +1,34 @@
+import threading
+import time
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import config
+
+class RateLimiter:
+    """
+    Spaces out requests so that no more than `rate` of them start each second,
+    across every thread sharing the limiter. A rate of None means no limit.
+    """
+
+    def __init__(self, rate: float | None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        """
+        Block until we are allowed to send the next request
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+
+# Shared by all the export scripts
+limiter = RateLimiter(config.mattermost.export_rate_limit)
@@ -1,11 +1,12 @@
 import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from pprint import pprint
 import json
 from datetime import datetime
 from tempfile import NamedTemporaryFile
 import webbrowser
-
-# Note the reverse chronological order
+from export_from_mattermost import archive
 
 if not os.path.exists('../downloaded/users.json'):
     print("File users.json does not exist. Please run export_users.py first", file=sys.stderr)
@@ -25,19 +26,16 @@ def get_printable_time(timestamp):
     return f"{time:%Y-%m-%d %H:%M}" # removed :%S, don't want to print
 
 def view_channel(channel_id):
-    filename = f'../downloaded/messages/{channel_id}.json'
-    if not os.path.exists(filename):
+    if not archive.exists(channel_id):
         print(f'File does not exist for {channel_id}. Run export_channel.py first.', file=sys.stderr)
         exit(1)
-    messages = json.load(open(filename, 'r'))
 
     html = NamedTemporaryFile(prefix='mattermost', mode='w', delete=False)
     print('<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1"><title>Exported Messages</title><link rel="stylesheet" href="https://cdn.simplecss.org/simple.min.css"></head><body>', file=html)
     print('<table>', file=html)
     print('<thead><tr><th>Date</th><th>Sender</th><th>Message</th><th>Type</th></tr></thead>', file=html)
     print('<tbody>', file=html)
-    # Reverse cause reverse chronological order
-    for message in reversed(messages):
+    for message in archive.read_messages(channel_id):
         date_str = get_printable_time(message['create_at'])
         username = get_username(message['user_id'])
         # Override for webhooks
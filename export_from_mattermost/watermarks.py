@@ -0,0 +1,43 @@
+"""
+Remembers, for each exported channel, the most recent `update_at` we have seen,
+so that later exports only need to ask Mattermost for what changed since then.
+"""
+
+import json
+import os
+import threading
+
+from files import atomic_open
+
+WATERMARKS_FILE = '../downloaded/watermarks.json'
+
+_lock = threading.Lock()
+_watermarks: dict[str, int] = None
+
+def _load():
+    global _watermarks
+    if _watermarks is None:
+        if os.path.exists(WATERMARKS_FILE):
+            _watermarks = json.load(open(WATERMARKS_FILE, 'r'))
+        else:
+            _watermarks = {}
+    return _watermarks
+
+
+def get_watermark(channel_id) -> int | None:
+    """
+    Get the last `update_at` (in milliseconds) seen for the given channel,
+    or None if the channel has never been exported with a watermark
+    """
+    with _lock:
+        return _load().get(channel_id)
+
+
+def set_watermark(channel_id, update_at: int):
+    """
+    Remember that everything in the given channel up to `update_at` has been saved
+    """
+    with _lock:
+        _load()[channel_id] = update_at
+        with atomic_open(WATERMARKS_FILE) as f:
+            json.dump(_watermarks, f)
@@ -0,0 +1,108 @@
+"""
+Exported Mattermost teams, channels and users, indexed by ID and by name.
+
+The files are only read the first time something is looked up, and can be read
+again with `catalog.refresh()` (for instance after exporting again).
+"""
+
+import json
+import os
+
+class Catalog:
+    """
+    Dictionary indexes over teams.json, channels.json and users.json
+    """
+
+    def __init__(self, directory='../downloaded'):
+        self.directory = directory
+        self._loaded = False
+
+    def _load(self, name) -> list[dict]:
+        filename = f'{self.directory}/{name}.json'
+        if not os.path.exists(filename):
+            return []
+        return json.load(open(filename, 'r'))
+
+    def refresh(self):
+        """
+        (Re-)read the exported files
+        """
+        self._teams = self._load('teams')
+        self._channels = self._load('channels')
+        self._users = self._load('users')
+
+        self._teams_by_id = {team['id']: team for team in self._teams}
+        self._teams_by_name = {team['name']: team for team in self._teams}
+        self._channels_by_id = {}
+        self._channels_by_name = {}
+        self._channels_by_team = {}
+        for channel in self._channels:
+            self._index_channel(channel)
+        self._users_by_id = {user['id']: user for user in self._users}
+        self._users_by_username = {user['username']: user for user in self._users}
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.refresh()
+
+    def _index_channel(self, channel):
+        self._channels_by_id[channel['id']] = channel
+        self._channels_by_name[(channel['team_id'], channel['name'])] = channel
+        self._channels_by_team.setdefault(channel['team_id'], []).append(channel)
+
+    def add_channel(self, channel: dict):
+        """
+        Add a channel that is not in the export (e.g. one fetched from Mattermost)
+        """
+        self._ensure_loaded()
+        if channel['id'] not in self._channels_by_id:
+            self._channels.append(channel)
+            self._index_channel(channel)
+
+    @property
+    def teams(self) -> list[dict]:
+        self._ensure_loaded()
+        return self._teams
+
+    @property
+    def channels(self) -> list[dict]:
+        self._ensure_loaded()
+        return self._channels
+
+    @property
+    def users(self) -> list[dict]:
+        self._ensure_loaded()
+        return self._users
+
+    def get_team(self, team_id) -> dict | None:
+        self._ensure_loaded()
+        return self._teams_by_id.get(team_id)
+
+    def get_team_by_name(self, team_name) -> dict | None:
+        self._ensure_loaded()
+        return self._teams_by_name.get(team_name)
+
+    def get_channel(self, channel_id) -> dict | None:
+        self._ensure_loaded()
+        return self._channels_by_id.get(channel_id)
+
+    def get_channel_by_name(self, team_id, channel_name) -> dict | None:
+        self._ensure_loaded()
+        return self._channels_by_name.get((team_id, channel_name))
+
+    def get_team_channels(self, team_id) -> list[dict]:
+        self._ensure_loaded()
+        return self._channels_by_team.get(team_id, [])
+
+    def get_user(self, user_id) -> dict | None:
+        self._ensure_loaded()
+        return self._users_by_id.get(user_id)
+
+    def get_user_by_username(self, username) -> dict | None:
+        self._ensure_loaded()
+        return self._users_by_username.get(username)
+
+
+# Shared by the importer and the bridge
+catalog = Catalog()
@@ -6,18 +6,17 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import json
 import asyncio
-from import_to_matrix.import_team import import_team
+from import_to_matrix.import_team import import_teams
+from import_to_matrix.catalog import catalog
+from export_from_mattermost.async_api import mm_async
 import os
 
 # change to the script's location
 os.chdir(os.path.dirname(__file__))
 
-teams = json.load(open('../downloaded/teams.json', 'r'))
-
 async def import_all_teams():
-    for team in teams:
-        print(f"# Importing {team['display_name']}")
-        await import_team(team['name'])
+    await import_teams([team['name'] for team in catalog.teams])
+    await mm_async.close()
 
 if __name__ == '__main__':
     asyncio.run(import_all_teams())
\ No newline at end of file
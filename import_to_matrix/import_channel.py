@@ -2,6 +2,10 @@
 
 import asyncio
 import json
+from collections import Counter, deque
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from itertools import islice
 import os
 import sys
 
@@ -12,32 +16,37 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from import_to_matrix.import_message import import_message
+from import_to_matrix.import_message import import_message, prepare_message
 from import_to_matrix.import_user import import_user
 from import_to_matrix.matrix import (config, get_alias_mxid, get_app_service,
-                    get_user_mxid_by_localpart, room_exists)
-from mautrix.types import RoomCreatePreset
-from mautrix.client.api.events import EventMethods
-from import_to_matrix.message_state import MessageState
-from export_from_mattermost.login import mm
+                    resolve_room_alias)
+from mautrix.types import RoomCreatePreset, EventType, SpaceChildStateEventContent, SpaceParentStateEventContent
+from import_to_matrix.message_state import AsyncMessageState
+from import_to_matrix.catalog import catalog
+from import_to_matrix.room_mapping import remember_channel_room
+from import_to_matrix.not_in_mautrix import DeferredPins, remember_space_child
+from export_from_mattermost.async_api import mm_async
+from export_from_mattermost import archive
 from progress.bar import Bar
 from mattermost import ApiException
 
 if not os.path.exists('../downloaded/channels.json'):
     print(f'channels.json not found! Run export_channel_list.py first.', file=sys.stderr)
     exit(1)
-channels = json.load(open('../downloaded/channels.json', 'r'))
-teams = json.load(open('../downloaded/teams.json', 'r'))
 
-def get_mattermost_channel(channel_id):
+# How many messages to read from disk at a time while importing
+READ_BATCH_SIZE = 1000
+
+async def get_mattermost_channel(channel_id):
     """
     Get the Mattermost record from the given channel, by reading
     the exported data.
     """
-    results = [channel for channel in channels if channel['id'] == channel_id]
-    if not results:
-        return mm.get_channel(channel_id)
-    return results[0]
+    channel = catalog.get_channel(channel_id)
+    if not channel:
+        channel = await mm_async.get_channel(channel_id)
+        catalog.add_channel(channel)
+    return channel
 
 def get_alias_localpart(team, channel):
     """
@@ -54,16 +63,20 @@ def get_alias_localpart_from_channel_json(channel):
     """
     # perhaps this is where we can add a configuration option to omit the
     # team name
-    team = [team for team in teams if team['id'] == channel['team_id']][0]
+    team = catalog.get_team(channel['team_id'])
     return get_alias_localpart(team['name'], channel['name'])
 
 
-async def create_room(alias_localpart, power_level_override: dict=None, creator_mxid=None, **kwargs):
+async def create_room(alias_localpart, power_level_override: dict=None, creator_mxid=None, initial_state: list=None, **kwargs):
     """
     Creates a Matrix room with the given properties, and invites and makes admin the
     specified people in the config. Returns the room ID of the newly created room or 
-    the already existing room, if it already exists, and whether the channel has just
-    been created, as a tuple.
+    the already existing room, if it already exists, and whether the room already
+    existed, as a tuple.
+
+    Everything that only needs to be set once (`initial_state`, invites) is sent
+    along with the room creation, and nothing is sent for existing rooms.
+
     Accepted kwargs include:
     * name
     * power_level_override
@@ -72,44 +85,42 @@ async def create_room(alias_localpart, power_level_override: dict=None, creator_
     app_service = get_app_service()
     api = app_service.bot_intent()
 
-    # First, check if the room already exists
-    already_exists = await room_exists(get_alias_mxid(alias_localpart))
-
-    # If it already exists, resolve its ID
-    if already_exists:
-        alias_info = await api.resolve_room_alias(get_alias_mxid(alias_localpart))
-        room_id = alias_info.room_id
-
-    # If it doesn't exist, create it
-    if not already_exists:
-        # Make everyone in config admin
-        if not power_level_override: power_level_override = {}
-        power_level_override.setdefault('users', {})
-        power_level_override['users'] |= \
-            {user: 100 for user in config.matrix.users} | \
-            {get_user_mxid_by_localpart(config.matrix.username): 100} # plus the bot account ofc
-        if creator_mxid:
-            user_api = app_service.intent(creator_mxid)
-        else:
-            user_api = app_service.bot_intent()
-        room_id = await user_api.create_room(
-            alias_localpart=alias_localpart, 
-            power_level_override=power_level_override,
-            **kwargs
-        )
-        # Invite bot user if needed
-        await api.ensure_joined(room_id, bot=user_api) # I see the advantage of this
-
-    # Invite everyone in the config
-    for user in config.matrix.users:
-        await api.invite_user(room_id, user)
+    # If it already exists, there is nothing to do
+    room_id = await resolve_room_alias(get_alias_mxid(alias_localpart))
+    if room_id:
+        return room_id, True
+
+    # Make everyone in config admin
+    if not power_level_override: power_level_override = {}
+    power_level_override.setdefault('users', {})
+    power_level_override['users'] |= \
+        {user: 100 for user in config.matrix.users} | \
+        {api.mxid: 100} # plus the bot account ofc
+    if creator_mxid:
+        user_api = app_service.intent(creator_mxid)
+    else:
+        user_api = api
+    # Invite everyone in the config (and the bot, if needed)
+    invitees = list(config.matrix.users)
+    if user_api.mxid != api.mxid:
+        invitees.append(api.mxid)
+    room_id = await user_api.create_room(
+        alias_localpart=alias_localpart, 
+        power_level_override=power_level_override,
+        initial_state=initial_state or [],
+        invitees=invitees,
+        **kwargs
+    )
+    # Join the bot user if needed (it was invited, so this only takes one request)
+    await api.ensure_joined(room_id, bot=user_api)
 
-    return room_id, already_exists
+    return room_id, False
 
 
-async def create_channel_from_json(channel):
+async def create_channel_from_json(channel, space_id=None):
     """
-    Creates a Mattermost channel with the given channel JSON into a Matrix room.
+    Creates a Mattermost channel with the given channel JSON into a Matrix room,
+    in the given space (room ID), if any.
     Returns the room ID on Matrix
     """
     app_service = get_app_service()
@@ -142,77 +153,219 @@ async def create_channel_from_json(channel):
     if creator_mxid:
         power_level_override.setdefault('users', {})
         power_level_override['users'] |= {creator_mxid: 100}
+    initial_state = [
+        # Custom state event to more easily indicate what channel we are on
+        {
+            'type': 'edu.mit.sipb.mattermost',
+            'state_key': '',
+            'content': {'channel_id': channel['id']},
+        },
+    ]
+    if space_id:
+        initial_state.append({
+            'type': str(EventType.SPACE_PARENT),
+            'state_key': space_id,
+            'content': SpaceParentStateEventContent(via=[config.matrix.homeserver]).serialize(),
+        })
     room_id, already_exists = await create_room(
         alias_localpart=alias_localpart,
         creator_mxid=creator_mxid,
         preset=RoomCreatePreset.PUBLIC,
         name=channel['display_name'],
         power_level_override=power_level_override,
+        initial_state=initial_state,
     )
-    
-    # Send custom state event to more easily indicate what channel we are on
-    await EventMethods.send_state_event(api, room_id, 'edu.mit.sipb.mattermost', {
-        'channel_id': channel['id'],
-    })
 
+    # The parent event is already there, but the space needs to know about its child too
+    if space_id and not already_exists:
+        await api.send_state_event(space_id, EventType.SPACE_CHILD, SpaceChildStateEventContent(via=[config.matrix.homeserver]), room_id)
+        await remember_space_child(space_id, room_id)
+
+    await remember_channel_room(channel['id'], room_id)
     return room_id, already_exists
 
 
-async def create_channel(channel_id):
+async def create_channel(channel_id, space_id=None):
     """
-    Create a Mattermost channel (with given `channel_id`) into a Matrix room.
+    Create a Mattermost channel (with given `channel_id`) into a Matrix room,
+    in the given space (room ID), if any.
     Returns the room ID on Matrix
     """
-    channel = get_mattermost_channel(channel_id)
-    return await create_channel_from_json(channel)
+    channel = await get_mattermost_channel(channel_id)
+    return await create_channel_from_json(channel, space_id)
 
 
 
-async def import_channel(channel_id):
+async def import_messages(messages, room_id, topic_equivalent, thread_equivalent, state: AsyncMessageState, thread_sizes, bar: Bar):
+    """
+    Imports the given messages (an async iterable) in order into the given room.
+
+    While a message is being sent, the next `config.matrix.import_prefetch` messages
+    are prepared in the background (ghosts, rendering and uploads, see
+    `prepare_message`), so that sending is the only thing done one message at a time.
+    """
+    # Messages waiting to be sent, with the task preparing each of them
+    pending = deque()
+    # Setting the pinned events once per pin would be quadratic
+    pins = DeferredPins(room_id)
+
+    async def send_next():
+        message, preparation = pending.popleft()
+        await import_message(message, room_id, topic_equivalent, thread_equivalent, state, thread_sizes, prepared=await preparation, pins=pins)
+        await state.set_checkpoint(message['channel_id'], message['id'], message['create_at'])
+        bar.next()
+
+    try:
+        async for message in messages:
+            pending.append((message, asyncio.ensure_future(prepare_message(message))))
+            if len(pending) > config.matrix.import_prefetch:
+                await send_next()
+        while pending:
+            await send_next()
+    finally:
+        # (the pins of messages that were sent, even if a later message failed)
+        await pins.flush()
+        # Do not leave anything running in the background if sending failed
+        for _, preparation in pending:
+            preparation.cancel()
+
+
+@dataclass
+class ChannelSummary:
     """
-    Imports the entire Mattermost channel with given ID into a Matrix channel,
-    and adds the users chosen in the config and makes them admin
+    What we need to know about a whole channel before importing it
     """
-    state = MessageState()
-    filename = f'../downloaded/messages/{channel_id}.json'
-    if not os.path.exists(filename):
+
+    # Number of messages in the channel
+    count: int = 0
+
+    # Whether the channel has any purpose change
+    has_purpose_change: bool = False
+
+    # Number of messages in each thread (including the root), by root ID
+    thread_sizes: Counter = field(default_factory=Counter)
+
+
+def summarize_channel(channel_id) -> ChannelSummary:
+    """
+    Go over the channel once, only keeping what the `auto` topic and thread
+    options need, so that the channel never needs to be fully in memory
+    """
+    summary = ChannelSummary()
+    for message in archive.read_messages(channel_id):
+        summary.count += 1
+        if message['type'] == 'system_purpose_change':
+            summary.has_purpose_change = True
+        if message['root_id']:
+            summary.thread_sizes[message['root_id']] += 1
+    # Count the roots too
+    for root_id in summary.thread_sizes:
+        summary.thread_sizes[root_id] += 1
+    return summary
+
+
+async def read_messages_async(channel_id):
+    """
+    Stream the messages of a channel (see `archive.read_messages`), reading and
+    parsing them in a worker thread, `READ_BATCH_SIZE` at a time, so that other
+    channels can keep importing meanwhile
+    """
+    messages = archive.read_messages(channel_id)
+    while batch := await asyncio.to_thread(lambda: list(islice(messages, READ_BATCH_SIZE))):
+        for message in batch:
+            yield message
+
+
+async def get_messages_after_checkpoint(messages, checkpoint, state: AsyncMessageState, on_skipped):
+    """
+    From the messages of a channel (in chronological order), get the ones that
+    come after the given checkpoint (see `MessageState.get_checkpoint`).
+    Calls `on_skipped()` for every message that is left out.
+    """
+    checkpoint_id, checkpoint_create_at = checkpoint
+    passed_checkpoint = False
+    async for message in messages:
+        if message['create_at'] < checkpoint_create_at:
+            on_skipped()
+            continue
+        # Several posts may have been created in the same millisecond
+        if message['create_at'] == checkpoint_create_at and not passed_checkpoint:
+            passed_checkpoint = message['id'] == checkpoint_id
+            on_skipped()
+            continue
+        # We may have crashed after sending this message but before saving the checkpoint
+        if await state.get_matrix_event(message['id']):
+            on_skipped()
+            continue
+        yield message
+
+
+async def import_channel(channel_id, bar: Bar = None, space_id=None, add_to_bar=False):
+    """
+    Imports the entire Mattermost channel with given ID into a Matrix channel
+    (in the given space, if any), and adds the users chosen in the config and
+    makes them admin
+
+    If a progress bar is given (when importing many channels at once), it is advanced
+    once per message instead of showing a progress bar just for this channel. If
+    `add_to_bar` is set, the number of messages of the channel is added to its total
+    first (for channels that could not be counted up front).
+
+    If the channel was (partially) imported before, only the messages after the last
+    imported one are imported, so this both resumes interrupted imports and adds new
+    messages to existing rooms.
+
+    Messages are streamed from disk, so memory use does not depend on the size
+    of the channel.
+    """
+    state = AsyncMessageState()
+    if not archive.exists(channel_id):
         print(f'File does not exist for {channel_id}. Run export_channel.py first.', file=sys.stderr)
         exit(1)
-    messages = json.load(open(filename, 'r'))
 
-    channel = get_mattermost_channel(channel_id)
-    room_id, already_existed = await create_channel_from_json(channel)
+    channel = await get_mattermost_channel(channel_id)
+    room_id, already_existed = await create_channel_from_json(channel, space_id)
 
-    # If we chose "auto" for topic changes, choose just one to bridge
     topic_equivalent = config.mattermost.backfill.topic_equivalent
+    thread_equivalent = config.mattermost.backfill.thread_equivalent
+
+    # The "auto" options need to look at the whole channel first
+    summary = None
+    if topic_equivalent == 'auto' or thread_equivalent == 'auto':
+        summary = await asyncio.to_thread(summarize_channel, channel_id)
+    count = summary.count if summary else await asyncio.to_thread(archive.count_messages, channel_id)
+    if bar and add_to_bar:
+        bar.max += count
+
+    # If we chose "auto" for topic changes, choose just one to bridge
     if topic_equivalent == 'auto':
         # Prefer purpose if there is at least one purpose change
-        if any(message['type'] == 'system_purpose_change' for message in messages):
+        if summary.has_purpose_change:
             topic_equivalent = 'purpose'
         # Otherwise, use the header change
         else:
             topic_equivalent = 'header'
 
-    thread_equivalent = config.mattermost.backfill.thread_equivalent
-    # If we choose "auto" for thread changes, calculate thread sizes
+    # If we choose "auto" for thread changes, we need thread sizes
     # (including the root)
-    thread_sizes = None
-    if thread_equivalent == 'auto':
-        thread_sizes = {message['id']: 1 for message in messages}
-        for message in messages:
-            if message['root_id']:
-                thread_sizes[message['root_id']] += 1
-                del thread_sizes[message['id']]
-
-    # Reverse cause reverse chronological order
-    if already_existed and config.matrix.skip_existing:
+    thread_sizes = summary.thread_sizes if thread_equivalent == 'auto' else None
+
+    # A checkpoint only means something for the room it was made in: if the room
+    # was just created (e.g. the old one was deleted), start from scratch
+    checkpoint = None
+    if config.matrix.resume_imports and already_existed:
+        checkpoint = await state.get_checkpoint(channel_id)
+
+    if already_existed and config.matrix.skip_existing and not checkpoint:
         print(f'Skipping import of already existing channel "{channel["display_name"]}"')
+        if bar:
+            bar.next(count)
     else:
-        with Bar(f"Importing {channel['name']}", max=len(messages)) as bar:
-            for message in reversed(messages):
-                await import_message(message, room_id, topic_equivalent, thread_equivalent, state, thread_sizes)
-                
-                bar.next()
+        with nullcontext(bar) if bar else Bar(f"Importing {channel['name']}", max=count) as bar:
+            messages = read_messages_async(channel_id)
+            if checkpoint:
+                messages = get_messages_after_checkpoint(messages, checkpoint, state, on_skipped=bar.next)
+            await import_messages(messages, room_id, topic_equivalent, thread_equivalent, state, thread_sizes, bar)
 
     return room_id
 
@@ -224,6 +377,9 @@ if __name__ == '__main__':
         print('You may get the channel ID from Mattermost ("view info") or channels.json.', file=sys.stderr)
         exit(1)
     channel_id = sys.argv[1]
-    asyncio.run(import_channel(channel_id))
+    async def main():
+        await import_channel(channel_id)
+        await mm_async.close()
+    asyncio.run(main())
     # Close the session when done
     asyncio.run(get_app_service().session.close())
@@ -1,5 +1,7 @@
+import asyncio
 import json
 import sys
+from dataclasses import dataclass, field
 import markdown
 import mautrix.errors
 import os
@@ -13,9 +15,10 @@ from mautrix.types import (BaseFileInfo, BaseMessageEventContent, EventType,
                            Membership, MemberStateEventContent, MessageType,
                            RoomNameStateEventContent,
                            RoomTopicStateEventContent, TextMessageEventContent)
-from import_to_matrix.message_state import MessageState
-from import_to_matrix.not_in_mautrix import join_user_to_room, pin_message
-from export_from_mattermost.login import mm
+from import_to_matrix.message_state import AsyncMessageState
+from import_to_matrix.media_cache import upload_file_cached
+from import_to_matrix.not_in_mautrix import join_user_to_room, pin_message, get_membership, remember_membership, DeferredPins
+from export_from_mattermost.async_api import mm_async
 
 emojis: dict = json.load(open('../downloaded/emoji.json', 'r'))
 emojis_inverse: dict = json.load(open('../downloaded/emoji_inverse.json', 'r'))
@@ -85,11 +88,118 @@ def get_reactions(reactions):
     return remove_duplicates_special({get_reaction(reaction) for reaction in reactions})
 
 
-async def import_message(message, room_id, topic_equivalent, thread_equivalent, state: MessageState, thread_sizes = None):
+@dataclass
+class PreparedMessage:
+    """
+    Everything needed to send a message that does not depend on the messages before it,
+    so that it can be done ahead of time (see `prepare_message`)
+    """
+
+    # The ghost that sends the message
+    user_mxid: str
+
+    # For webhook and Zephyr ghosts, the profile to give them right before sending
+    # (their display name can change from one message to the next, so it cannot be
+    # set ahead of time), as keyword arguments for `create_user`
+    sender_profile: dict | None = None
+
+    # The message rendered as HTML, if it has text
+    formatted_body: str | None = None
+
+    # The mxc:// URI of each file in the message, already uploaded
+    file_uris: list[str] = field(default_factory=list)
+
+    # The ghost of each Mattermost user who reacted to the message
+    reactor_mxids: dict[str, str] = field(default_factory=dict)
+
+
+def get_override_sender(message) -> dict | None:
+    """
+    If the given Mattermost message overrides its username (webhooks, Zephyr),
+    get the profile of the ghost that should send it, as keyword arguments for
+    `create_user`. Otherwise, None.
+    """
+    # Respect request to override username
+    if 'override_username' not in message['props']:
+        return None
+    username = message['props']['override_username']
+    if config.prefer_usernames:
+        display_name = username
+    else:
+        display_name = message['props'].get('webhook_display_name') or username
+    user_mxid = get_bridged_user_mxid(username)
+    platform = 'Mattermost' # or mattermost webhook perhaps?
+    # Apply a custom prefix if using Zephyr (MIT-specific functionality)
+    if 'from_zephyr' in message['props']:
+        user_mxid = user_mxid.replace(config.matrix.user_prefix, '_zephyr_')
+        platform = 'Zephyr'
+    display_name = config.matrix.display_name_format.format(name=display_name, platform=platform)
+    # TODO: set the avatar, perhaps a hardcoded one, or the pfp of the account itself
+    # if it really is a bot...
+    # note that even mattermost itself uses the pfp of the user who created the webhook
+    # if "Enable integrations to override profile picture icons" is disabled
+    return {'mxid': user_mxid, 'display_name': display_name, 'is_zephyr': platform == 'Zephyr'}
+
+
+async def upload_file(user_api, file):
+    """
+    Uploads a file from a Mattermost message, and returns its mxc:// URI
+    """
+    filename = f'../downloaded/media/{file["id"]}'
+    if not os.path.exists(filename):
+        # Download if we haven't yet (streamed to disk, so big files never fill up memory)
+        os.makedirs('../downloaded/media', exist_ok=True)
+        await mm_async.download_media(file['id'])
+
+    return await upload_file_cached(user_api, filename, file['mime_type'], file['name'])
+
+
+async def prepare_message(message) -> PreparedMessage:
+    """
+    Does everything needed to send the given message that can be done out of order:
+    creating or updating the ghosts of the sender and reactors, rendering the text,
+    and uploading the files. Nothing is sent to the room.
+
+    The profile of webhook and Zephyr ghosts is not set here, since it may differ
+    between messages: `import_message` sets it when sending.
+    """
+    sender_profile = get_override_sender(message)
+    if sender_profile:
+        prepared = PreparedMessage(user_mxid=sender_profile['mxid'], sender_profile=sender_profile)
+        # (it needs to exist to upload files)
+        await get_app_service().intent(prepared.user_mxid).ensure_registered()
+    else:
+        prepared = PreparedMessage(user_mxid=await import_user(message['user_id']))
+
+    # Only normal messages have content
+    if not message['type'] or message['type'] == 'slack_attachment':
+        if message['message']:
+            prepared.formatted_body = md.convert(message['message'])
+
+        if 'files' in message['metadata']:
+            user_api = get_app_service().intent(prepared.user_mxid)
+            for file in message['metadata']['files']:
+                prepared.file_uris.append(await upload_file(user_api, file))
+
+        if 'reactions' in message['metadata']:
+            for user_id, _, _ in get_reactions(message['metadata']['reactions']):
+                if user_id not in prepared.reactor_mxids:
+                    prepared.reactor_mxids[user_id] = await import_user(user_id)
+
+    return prepared
+
+
+async def import_message(message, room_id, topic_equivalent, thread_equivalent, state: AsyncMessageState, thread_sizes = None, prepared: PreparedMessage = None, pins: DeferredPins = None):
     """
     Import a specific message from the Mattermost JSON format
     into the specified room ID
 
+    If the message has already been prepared with `prepare_message`, pass it as
+    `prepared`, otherwise it is prepared right away.
+
+    If `pins` is given (during backfill), pins are collected there
+    instead of being set right away.
+
     topic_equivalent can be header, purpose or both, for what to treat
     as a Matrix topic
 
@@ -114,53 +224,40 @@ async def import_message(message, room_id, topic_equivalent, thread_equivalent,
     app_service = get_app_service()
     api = app_service.bot_intent()
 
-    # Respect request to override username
-    if 'override_username' in message['props']:
-        username = message['props']['override_username']
-        if config.prefer_usernames:
-            display_name = username
-        else:
-            display_name = message['props'].get('webhook_display_name') or username
-        user_mxid = get_bridged_user_mxid(username)
-        platform = 'Mattermost' # or mattermost webhook perhaps?
-        # Apply a custom prefix if using Zephyr (MIT-specific functionality)
-        if 'from_zephyr' in message['props']:
-            user_mxid = user_mxid.replace(config.matrix.user_prefix, '_zephyr_')
-            platform = 'Zephyr'
-        display_name = config.matrix.display_name_format.format(name=display_name, platform=platform)
-        # TODO: set the avatar, perhaps a hardcoded one, or the pfp of the account itself
-        # if it really is a bot...
-        # note that even mattermost itself uses the pfp of the user who created the webhook
-        # if "Enable integrations to override profile picture icons" is disabled
-        await create_user(user_mxid, display_name, is_zephyr=platform == 'Zephyr')
+    if prepared is None:
+        prepared = await prepare_message(message)
+    user_mxid = prepared.user_mxid
+    if prepared.sender_profile:
+        # In order, so each message is sent with its own display name
+        await create_user(**prepared.sender_profile)
 
+    if 'override_username' in message['props']:
         # add user to the room, otherwise the join timestamp will be wrong...
         await join_user_to_room(user_mxid, room_id, timestamp=message['create_at'])
-    else:
-        user_mxid = await import_user(message['user_id'])
-        
+
     user_api = app_service.intent(user_mxid)
-    event_ids = []
+    # (event ID, role) of every event sent for this message
+    events = []
 
     # Messages without a type are normal messages
     if not message['type'] or message['type'] == 'slack_attachment':
         # We stop typing when we send a message
         await user_api.set_typing(room_id, 0)
 
-        matrix_thread_root = state.get_matrix_event(message['root_id'])
+        matrix_thread_root = await state.get_matrix_event(message['root_id'])
         # the second condition is needed because malfunctioning Mattermost bots may reply to a "System message"
         # which we do not consider a message (although they do have Matrix event IDs; I'm not sure if
         # you can technically reply to a member event, but tbh you shouldn't)
         if message['root_id'] and matrix_thread_root:
             # not really the message we are replying to but the one above, because
             # Mattermost does not keep track of which message you clicked "reply" on
-            mattermost_reply_to = state.get_most_recent_message_in_thread(message['root_id']) or message['root_id']
-            matrix_reply_to = state.get_matrix_event(mattermost_reply_to)
+            mattermost_reply_to = await state.get_most_recent_message_in_thread(message['root_id']) or message['root_id']
+            matrix_reply_to = await state.get_matrix_event(mattermost_reply_to)
             
             # application services may not necessarily process messages in order
             # which is another reason why we cannot easily support `thread_equivalent='reply'`
             # when running on real-time
-            state.set_most_recent_message_in_thread(message['root_id'], message['id'])
+            await state.set_most_recent_message_in_thread(message['root_id'], message['id'])
 
             def set_reply_or_thread(content: BaseMessageEventContent):
                 if thread_equivalent == 'reply':
@@ -176,37 +273,22 @@ async def import_message(message, room_id, topic_equivalent, thread_equivalent,
             content = TextMessageEventContent(
                 msgtype=MessageType.TEXT,
                 body=message['message'],
-                formatted_body=md.convert(message['message']),
+                formatted_body=prepared.formatted_body,
                 format=Format.HTML,
             )
             # set reply if needed
             set_reply_or_thread(content)
             # send message
-            event_ids.append(text_event_id := await user_api.send_message(
+            events.append((await user_api.send_message(
                 room_id,
                 content,
                 timestamp=message['create_at']
-            ))
-            state.remember_matrix_text_event(
-                mattermost_id=message['id'],
-                matrix_id=text_event_id,
-            )
+            ), 'text'))
             # TODO: if edited, edit it right after so it says edited
 
         # Handle media
         if 'files' in message['metadata']:
-            for file in message['metadata']['files']:
-                # Upload first
-                filename = f'../downloaded/media/{file["id"]}'
-                if os.path.exists(filename):
-                    with open(filename, 'rb') as f:
-                        contents = f.read()
-                else:
-                    # Download if we haven't yet (only in memory is fine)
-                    contents = mm.get_file(file['id']).content
-                    
-                file_uri = await user_api.upload_media(contents, file['mime_type'], file['name'])
-                
+            for file, file_uri in zip(message['metadata']['files'], prepared.file_uris):
                 is_image = file['mime_type'].startswith('image')
 
                 # Send message
@@ -222,13 +304,13 @@ async def import_message(message, room_id, topic_equivalent, thread_equivalent,
                     ) if is_image else BaseFileInfo(mimetype=file['mime_type'], size=file['size']),
                 )
                 set_reply_or_thread(content)
-                event_ids.append(await user_api.send_message(room_id, content, timestamp=message['create_at']))
+                events.append((await user_api.send_message(room_id, content, timestamp=message['create_at']), 'media'))
 
         # Handle Slack attachments
         if message['type'] == 'slack_attachment' and 'attachments' in message['props']:
             print('Warning: Slack-type messages are not fully supported. Send an issue/PR if you want better support.', file=sys.stderr)
             for attachment in message['props']['attachments']:
-                event_ids.append(await user_api.send_message(
+                events.append((await user_api.send_message(
                     room_id,
                     TextMessageEventContent(
                         msgtype=MessageType.TEXT,
@@ -239,58 +321,61 @@ async def import_message(message, room_id, topic_equivalent, thread_equivalent,
                         format=Format.HTML,
                     ),
                     timestamp=message['create_at'],
-                ))
+                ), 'attachment'))
 
         # if there was no message sent, there is nothing left to do
-        if not event_ids: return
+        if not events: return
 
-        # Store the full list of event IDs
-        # We will need it for deletions
-        state.set_matrix_event_list(message['id'], event_ids)
+        # Store every event ID (we will need them all for deletions)
+        await state.remember_matrix_events(message['id'], room_id, events)
 
         # Get the last event ID
-        event_id = event_ids[-1]
-
-        # store event ID
-        state.remember_matrix_event(mattermost_id=message['id'], matrix_id=event_id)
+        event_id, _ = events[-1]
 
         # Handle reactions
         # Specifically, react to the last event ID
         if 'reactions' in message['metadata']:
             for user_id, emoji, timestamp in get_reactions(message['metadata']['reactions']):
-                reactor_mxid = await import_user(user_id)
+                reactor_mxid = prepared.reactor_mxids[user_id]
                 reactor_api = app_service.intent(reactor_mxid)
                 await reactor_api.react(room_id, event_id, emoji, timestamp=timestamp)
 
         if message['is_pinned']:
-            await pin_message(user_api, room_id, event_id, timestamp=message['create_at'])
+            if pins:
+                await pins.pin_message(user_api, event_id, timestamp=message['create_at'])
+            else:
+                await pin_message(user_api, room_id, event_id, timestamp=message['create_at'])
     elif message['type'] == 'system_join_channel':
         await join_user_to_room(user_mxid, room_id, timestamp=message['create_at'])
     elif message['type'] == 'system_leave_channel':
-        await user_api.send_state_event(
-            room_id,
-            EventType.ROOM_MEMBER,
-            MemberStateEventContent(membership=Membership.LEAVE),
-            user_mxid,
-            timestamp=message['create_at'],
-        )
-    elif message['type'] == 'system_add_to_channel':
-        invited_user_id = message['props']['addedUserId']
-        invited_matrix_user = await import_user(invited_user_id)
-        try:
+        if await get_membership(room_id, user_mxid) in ('join', 'invite'):
             await user_api.send_state_event(
                 room_id,
                 EventType.ROOM_MEMBER,
-                MemberStateEventContent(
-                    membership=Membership.INVITE,
-                    displayname=await user_api.get_displayname(invited_matrix_user),
-                ),
-                invited_matrix_user,
+                MemberStateEventContent(membership=Membership.LEAVE),
+                user_mxid,
                 timestamp=message['create_at'],
             )
-        except mautrix.errors.request.MForbidden:
-            # ignore exception if you try to invite someone already in the room
-            pass
+            await remember_membership(room_id, user_mxid, Membership.LEAVE)
+    elif message['type'] == 'system_add_to_channel':
+        invited_user_id = message['props']['addedUserId']
+        invited_matrix_user = await import_user(invited_user_id)
+        if await get_membership(room_id, invited_matrix_user) not in ('join', 'invite'):
+            try:
+                await user_api.send_state_event(
+                    room_id,
+                    EventType.ROOM_MEMBER,
+                    MemberStateEventContent(
+                        membership=Membership.INVITE,
+                        displayname=await user_api.get_displayname(invited_matrix_user),
+                    ),
+                    invited_matrix_user,
+                    timestamp=message['create_at'],
+                )
+            except mautrix.errors.request.MForbidden:
+                # ignore exception if you try to invite someone already in the room
+                pass
+            await remember_membership(room_id, invited_matrix_user, Membership.INVITE)
         await join_user_to_room(invited_matrix_user, room_id, timestamp=message['create_at'])
     elif message['type'] == 'system_remove_from_channel':
         removed_user_id = message['props']['removedUserId']
@@ -304,11 +389,13 @@ async def import_message(message, room_id, topic_equivalent, thread_equivalent,
             removed_matrix_user,
             timestamp=message['create_at'],
         )
-        try:
-            await kick(user_api)
-        except mautrix.errors.request.MForbidden:
-            # kick using app service account if ghost does not have enough permissions
-            await kick(api)
+        if await get_membership(room_id, removed_matrix_user) in ('join', 'invite'):
+            try:
+                await kick(user_api)
+            except mautrix.errors.request.MForbidden:
+                # kick using app service account if ghost does not have enough permissions
+                await kick(api)
+            await remember_membership(room_id, removed_matrix_user, Membership.LEAVE)
     elif message['type'] == 'system_displayname_change':
         await user_api.send_state_event(
             room_id,
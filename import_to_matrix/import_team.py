@@ -5,9 +5,15 @@ import os
 import magic
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from import_to_matrix.import_channel import channels, teams, create_room, import_channel
+from import_to_matrix.import_channel import create_room, import_channel, get_mattermost_channel
+from import_to_matrix.catalog import catalog
+from export_from_mattermost.async_api import mm_async
 from import_to_matrix.matrix import get_app_service, config, get_room_avatar, set_room_avatar
-from mautrix.types import RoomCreateStateEventContent, RoomType, RoomCreatePreset, EventType, SpaceChildStateEventContent, SpaceParentStateEventContent
+from import_to_matrix.media_cache import upload_media_cached
+from import_to_matrix.not_in_mautrix import get_space_children, remember_space_child
+from mautrix.types import RoomCreateStateEventContent, RoomType, RoomCreatePreset, EventType, SpaceChildStateEventContent, SpaceParentStateEventContent, RoomAvatarStateEventContent
+from export_from_mattermost import archive
+from progress.bar import Bar
 
 # change to the script's location
 os.chdir(os.path.dirname(__file__))
@@ -16,7 +22,7 @@ def get_team_by_name(team_name):
     """
     Get a team JSON by name
     """
-    return [team for team in teams if team['name'] == team_name][0]
+    return catalog.get_team_by_name(team_name)
 
 
 def get_channels_by_team(team_id):
@@ -25,8 +31,8 @@ def get_channels_by_team(team_id):
     """
     return [
         channel['id']
-        for channel in channels
-        if channel['team_id'] == team_id and channel['id'] not in config.mattermost.skip_channels
+        for channel in catalog.get_team_channels(team_id)
+        if channel['id'] not in config.mattermost.skip_channels
     ]
 
 
@@ -41,52 +47,127 @@ async def create_space_for_team(team):
     """
     app_service = get_app_service()
     api = app_service.bot_intent()
-    
+
+    # Upload the avatar first, so it can be set along with the space creation
+    # (this is cached, so it is only uploaded once)
+    avatar_mxc = None
+    filename = f"../downloaded/pfp/{team['id']}"
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            avatar = f.read()
+        avatar_mxc = await upload_media_cached(
+            api,
+            data=avatar,
+            mime_type=magic.from_buffer(avatar, mime=True),
+            filename=team['name'],
+        )
+    initial_state = []
+    if avatar_mxc:
+        initial_state.append({
+            'type': str(EventType.ROOM_AVATAR),
+            'state_key': '',
+            'content': RoomAvatarStateEventContent(url=avatar_mxc).serialize(),
+        })
+
     # Create the space (room) (if it doesn't already exist)
-    room_mxid, _ = await create_room(
+    room_mxid, already_exists = await create_room(
         alias_localpart=get_team_alias_localpart(team['name']),
         name=team['display_name'],
         creation_content=RoomCreateStateEventContent(type=RoomType.SPACE),
         preset=RoomCreatePreset.PUBLIC,
         topic=team['description'],
+        initial_state=initial_state,
     )
 
     # Set avatar if not set
-    filename = f"../downloaded/pfp/{team['id']}"
-    if os.path.exists(filename):
-        with open(filename, 'rb') as f:
-            avatar = f.read()
-        if not await get_room_avatar(room_mxid):
-            avatar_mxc = await api.upload_media(
-                data=avatar,
-                mime_type=magic.from_buffer(avatar, mime=True),
-                filename=team['name'],
-            )
-            await set_room_avatar(room_mxid, avatar_mxc)
+    if already_exists and avatar_mxc and not await get_room_avatar(room_mxid):
+        await set_room_avatar(room_mxid, avatar_mxc)
 
     return room_mxid
 
 
-async def import_team(team_name):
+async def import_channels(channel_ids, space_ids: dict = None, on_imported=None):
     """
-    Import a Mattermost team by name. Currently only imports public
-    channels.
+    Import the given Mattermost channels, `config.matrix.import_workers` at a time,
+    with a single progress bar for all of them. Messages within a room are still
+    imported in order, but different rooms do not depend on each other.
+
+    New rooms are created in the space of their team, if `space_ids` (team ID ->
+    space room ID) is given.
+
+    Calls `await on_imported(channel_id, room_id)` once each channel is done.
     """
+    missing = [channel_id for channel_id in channel_ids if not archive.exists(channel_id)]
+    for channel_id in missing:
+        print(f'File does not exist for {channel_id}, skipping. Run export_channel.py first.', file=sys.stderr)
+
+    # Start with the biggest channels, so we are not left waiting for one of them at the end
+    # (channels in the old format would need to be read in full to be counted, so they
+    # are only estimated here, and counted once their import starts)
+    sizes = {
+        channel_id: archive.estimate_messages(channel_id)
+        for channel_id in channel_ids
+        if channel_id not in missing
+    }
+    channel_ids = sorted(sizes, key=sizes.get, reverse=True)
+    counted = {channel_id for channel_id in channel_ids if not archive.is_legacy(channel_id)}
+    semaphore = asyncio.Semaphore(config.matrix.import_workers)
+
+    with Bar(f"Importing {len(channel_ids)} channels", max=sum(sizes[channel_id] for channel_id in counted)) as bar:
+        async def import_one(channel_id):
+            async with semaphore:
+                space_id = None
+                if space_ids:
+                    space_id = space_ids.get((await get_mattermost_channel(channel_id))['team_id'])
+                room_id = await import_channel(channel_id, bar, space_id, add_to_bar=channel_id not in counted)
+                if on_imported:
+                    await on_imported(channel_id, room_id)
+
+        await asyncio.gather(*(import_one(channel_id) for channel_id in channel_ids))
+
+
+async def add_room_to_space(space_id, room_id):
+    """
+    Adds the given room to the given space, unless it is already there
+    """
+    # spec on spaces: https://spec.matrix.org/v1.7/client-server-api/#spaces
+    if room_id in await get_space_children(space_id):
+        return
     app_service = get_app_service()
     api = app_service.bot_intent()
+    await api.send_state_event(space_id, EventType.SPACE_CHILD, SpaceChildStateEventContent(via=[config.matrix.homeserver]), room_id)
+    await api.send_state_event(room_id, EventType.SPACE_PARENT, SpaceParentStateEventContent(via=[config.matrix.homeserver]), space_id)
+    await remember_space_child(space_id, room_id)
 
-    team = get_team_by_name(team_name)
-    team_id = await create_space_for_team(team)
-    channels = get_channels_by_team(team['id'])
 
-    # spec on spaces: https://spec.matrix.org/v1.7/client-server-api/#spaces
+async def import_teams(team_names):
+    """
+    Import the Mattermost teams with the given names. Currently only imports public
+    channels. Channels of all the teams are imported concurrently.
+    """
+    space_ids = {}
+    channels = []
+    for team_name in team_names:
+        team = get_team_by_name(team_name)
+        print(f"# Creating space for {team['display_name']}")
+        space_ids[team['id']] = await create_space_for_team(team)
+        channels.extend(get_channels_by_team(team['id']))
+
+    # New rooms are created inside their space, but rooms that already existed
+    # may not have been added to it
+    async def on_imported(channel_id, room_id):
+        team_id = (await get_mattermost_channel(channel_id))['team_id']
+        await add_room_to_space(space_ids[team_id], room_id)
 
-    for channel_id in channels:
-        if channel_id in config.mattermost.skip_channels:
-            continue
-        room_id = await import_channel(channel_id)
-        await api.send_state_event(team_id, EventType.SPACE_CHILD, SpaceChildStateEventContent(via=[config.matrix.homeserver]), room_id)
-        await api.send_state_event(room_id, EventType.SPACE_PARENT, SpaceParentStateEventContent(via=[config.matrix.homeserver]), team_id)
+    await import_channels(channels, space_ids, on_imported)
+
+
+async def import_team(team_name):
+    """
+    Import a Mattermost team by name. Currently only imports public
+    channels.
+    """
+    await import_teams([team_name])
 
 
 if __name__ == '__main__':
@@ -96,6 +177,9 @@ if __name__ == '__main__':
         print('You may get the channel ID from the Mattermost URL.', file=sys.stderr)
         exit(1)
     team_name = sys.argv[1]
-    asyncio.run(import_team(team_name))
+    async def main():
+        await import_team(team_name)
+        await mm_async.close()
+    asyncio.run(main())
     # Close the session when done
     asyncio.run(get_app_service().session.close())
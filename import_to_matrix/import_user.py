@@ -1,32 +1,101 @@
 import asyncio
+import hashlib
 import json
 import os
 import sys
+import time
 import magic
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from import_to_matrix.matrix import get_app_service, get_bridged_user_mxid, config
-from export_from_mattermost.login import mm
-from export_from_mattermost.media import get_profile_picture_bytes
+from import_to_matrix.store import get_store, run_in_store_thread
+from import_to_matrix.catalog import catalog
+from import_to_matrix.media_cache import get_uploaded_media, remember_uploaded_media
+from export_from_mattermost.async_api import mm_async
 os.chdir(os.path.dirname(__file__))
 
 if not os.path.exists('../downloaded/users.json'):
     print(f'users.json not found! Run export_users.py first.', file=sys.stderr)
     exit(1)
 
-users = json.load(open('../downloaded/users.json'))
 
-def get_mattermost_user(user_id):
+class ExpiringCache:
+    """
+    Dictionary-like cache whose entries are forgotten `ttl` seconds after being set
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        value, expires_at = self._entries[key]
+        if time.monotonic() > expires_at:
+            del self._entries[key]
+            return None
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+
+# Mattermost user ID -> Mattermost user dictionary
+_mattermost_users = ExpiringCache(config.matrix.user_cache_ttl)
+
+# Mattermost user ID -> MXID of its ghost, for ghosts that are up to date
+_ghosts = ExpiringCache(config.matrix.user_cache_ttl)
+
+# MXID -> (display name, avatar) we last set on that ghost
+_applied_profiles = ExpiringCache(config.matrix.user_cache_ttl)
+
+def _encode_json(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+def _decode_json(obj: bytes):
+    return json.loads(obj)
+
+# MXID -> {'sha256': hash of the avatar we last uploaded for it, 'mxc': its URI}
+# (sha256 is None if we removed its avatar). This lets us tell whether an avatar
+# changed without downloading the current one from Matrix.
+_avatars = get_store().table("avatars", _encode_json, _decode_json)
+
+def _remember_avatar(mxid, avatar_hash, mxc):
+    _avatars[mxid] = {'sha256': avatar_hash, 'mxc': mxc}
+
+# Mattermost user ID -> task currently importing it, so that concurrent
+# imports of the same user share the work
+_imports_in_progress: dict[str, asyncio.Future] = {}
+
+
+def invalidate_user(user_id):
+    """
+    Forget what we know about the given Mattermost user, so that it is fetched
+    and updated again the next time it is needed
+    """
+    _mattermost_users.pop(user_id)
+    _ghosts.pop(user_id)
+
+
+async def get_mattermost_user(user_id):
     """
     Get the Mattermost record from the given user, by querying Mattermost
     if possible, otherwise by reading the downloaded data.
     """
+    user = _mattermost_users.get(user_id)
+    if user:
+        return user
     try:
-        return mm.get_user(user_id)
+        user = await mm_async.get_user(user_id)
     except:
-        results = [user for user in users if user['id'] == user_id]
-        if not results:
+        user = catalog.get_user(user_id)
+        if not user:
             raise ValueError(f'Inexistent Mattermost user ID {user_id}')
-        return results[0]
+    _mattermost_users[user_id] = user
+    return user
 
 
 def get_displayname(user: dict):
@@ -54,6 +123,16 @@ async def create_user(mxid, display_name, avatar_mxc=None, avatar_bytes=None, av
     # specifying either type of avatar is mutually exclusive
     assert avatar_mxc is None or avatar_bytes is None
 
+    # Nothing to do if we have just set this same profile
+    profile = (
+        display_name,
+        avatar_mxc,
+        hashlib.sha256(avatar_bytes).hexdigest() if avatar_bytes else avatar_bytes,
+        is_zephyr,
+    )
+    if _applied_profiles.get(mxid) == profile:
+        return mxid
+
     app_service = get_app_service()
     user_api = app_service.intent(mxid)
 
@@ -68,27 +147,31 @@ async def create_user(mxid, display_name, avatar_mxc=None, avatar_bytes=None, av
         await user_api.set_displayname(display_name)
 
     # Set profile picture if needed
+    avatar_hash = profile[2]
+    current_avatar = await run_in_store_thread(_avatars.get, mxid)
     if avatar_bytes:
-        current_avatar_mxc = await user_api.get_avatar_url(mxid)
-        if current_avatar_mxc:
-            current_avatar = await user_api.download_media(current_avatar_mxc)
-
         # If picture has changed, update it
-        # (hopefully this isn't too slow overall, otherwise we would need some optimizations
-        #  to reduce the amount of traffic)
-        if not current_avatar_mxc or avatar_bytes != current_avatar:
-            avatar_mxc = await user_api.upload_media(
-                data=avatar_bytes,
-                mime_type=magic.from_buffer(avatar_bytes, mime=True),
-                filename=avatar_filename or 'pfp',
-            )
+        if not current_avatar or current_avatar['sha256'] != avatar_hash:
+            # Ghosts with the same picture share the upload
+            avatar_mxc = await run_in_store_thread(get_uploaded_media, avatar_hash)
+            if not avatar_mxc:
+                avatar_mxc = await user_api.upload_media(
+                    data=avatar_bytes,
+                    mime_type=magic.from_buffer(avatar_bytes, mime=True),
+                    filename=avatar_filename or 'pfp',
+                )
+                await run_in_store_thread(remember_uploaded_media, avatar_hash, avatar_mxc)
             await user_api.set_avatar_url(avatar_mxc)
+            await run_in_store_thread(_remember_avatar, mxid, avatar_hash, avatar_mxc)
     elif avatar_bytes is None:
         # Unset profile picture
         # We are setting it to the empty string. It is not defined anywhere, but it seems to work 
         # (https://github.com/matrix-org/matrix-spec/issues/1606)
-        await user_api.set_avatar_url('')
-    
+        if not current_avatar or current_avatar['sha256'] is not None:
+            await user_api.set_avatar_url('')
+            await run_in_store_thread(_remember_avatar, mxid, None, '')
+
+    _applied_profiles[mxid] = profile
     return mxid
 
 
@@ -106,7 +189,7 @@ async def import_user_from_json(user):
         # Only download if the user has a profile picture
         # Otherwise we get an image file with the person's initials
         if 'last_picture_update' in user:
-            avatar = get_profile_picture_bytes(user_id)
+            avatar = await mm_async.get_user_image(user_id)
     except:
         # Use downloaded profile picture only if request to Mattermost
         # failed for some reason
@@ -120,14 +203,37 @@ async def import_user_from_json(user):
         platform='Mattermost',
     )
 
-    return await create_user(mxid, display_name, avatar_bytes=avatar)
+    await create_user(mxid, display_name, avatar_bytes=avatar)
+    _mattermost_users[user_id] = user
+    _ghosts[user_id] = mxid
+    return mxid
 
 
 async def import_user(user_id):
     """
     Creates or updates a given Mattermost user into a Matrix bridged user.
     Returns its MXID.
+
+    Users are only checked again once `config.matrix.user_cache_ttl` seconds
+    have passed, or after `invalidate_user`.
     """
-    user = get_mattermost_user(user_id)
-    return await import_user_from_json(user)
+    mxid = _ghosts.get(user_id)
+    if mxid:
+        return mxid
+    if user_id not in _imports_in_progress:
+        async def fetch_and_import():
+            user = await get_mattermost_user(user_id)
+            return await import_user_from_json(user)
+
+        # (registered before awaiting anything, so that concurrent calls find it)
+        task = asyncio.ensure_future(fetch_and_import())
+
+        def forget_task(_):
+            if _imports_in_progress.get(user_id) is task:
+                del _imports_in_progress[user_id]
+
+        task.add_done_callback(forget_task)
+        _imports_in_progress[user_id] = task
+    # (shielded, so that a caller being cancelled does not cancel it for everyone else)
+    return await asyncio.shield(_imports_in_progress[user_id])
 
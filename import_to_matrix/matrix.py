@@ -61,17 +61,25 @@ def get_alias_mxid(localpart):
     return f'#{localpart}:{config.matrix.homeserver}'
 
 
-async def room_exists(room_alias):
+async def resolve_room_alias(room_alias):
     """
-    Does the room with the given alias exist?
+    Get the room ID of the room with the given alias,
+    or None if it does not exist
     """
     app_service = get_app_service()
     api = app_service.bot_intent()
     try:
         alias_info = await api.resolve_room_alias(room_alias)
-        return True
+        return alias_info.room_id
     except mautrix.errors.request.MNotFound:
-        return False
+        return None
+
+
+async def room_exists(room_alias):
+    """
+    Does the room with the given alias exist?
+    """
+    return await resolve_room_alias(room_alias) is not None
 
 
 async def get_room_avatar(room_mxid):
@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mautrix.appservice import IntentAPI
+from mautrix.errors import MatrixConnectionError, MatrixRequestError
+from import_to_matrix.store import get_store, run_in_store_thread
+from import_to_matrix.message_state import _encode, _decode
+
+# SHA-256 of everything we have uploaded -> its mxc URI, so the same file is only
+# uploaded once, even if it is posted in several channels or we import again
+_uploads = get_store().table("media", _encode, _decode)
+
+# Size of the pieces we read from disk at a time, so big files are never fully in memory
+CHUNK_SIZE = 1024 * 1024
+
+# How many times to try streaming a file to Matrix before giving up, and how long
+# to wait after the first failure (doubling every time)
+UPLOAD_ATTEMPTS = 3
+RETRY_DELAY = 1
+
+def _is_retryable(error: MatrixRequestError | MatrixConnectionError):
+    """
+    Whether it is worth trying again after the given error
+    (connection problems, server errors or rate limits, but not e.g. a file that is too big)
+    """
+    if isinstance(error, MatrixConnectionError):
+        return True
+    return error.http_status >= 500 or error.http_status == 429
+
+def hash_file(filename) -> str:
+    """
+    Get the SHA-256 (as a hex string) of a file, reading it piece by piece
+    """
+    contents_hash = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            contents_hash.update(chunk)
+    return contents_hash.hexdigest()
+
+
+async def read_file_in_chunks(filename):
+    """
+    Read a file piece by piece, without blocking the event loop
+    """
+    with open(filename, 'rb') as f:
+        while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+            yield chunk
+
+def get_uploaded_media(contents_hash):
+    """
+    Get the mxc URI of an upload by the SHA-256 of its contents (as a hex string),
+    or None if it has not been uploaded
+    """
+    return _uploads.get(contents_hash)
+
+
+def remember_uploaded_media(contents_hash, mxc):
+    """
+    Remember that the contents with the given SHA-256 were uploaded to `mxc`
+    """
+    _uploads[contents_hash] = mxc
+
+
+async def upload_media_cached(user_api: IntentAPI, data: bytes, mime_type, filename) -> str:
+    """
+    Like user_api.upload_media, but reuses the previous upload if these exact
+    contents have already been uploaded. Returns the mxc URI.
+    """
+    contents_hash = hashlib.sha256(data).hexdigest()
+    mxc = await run_in_store_thread(get_uploaded_media, contents_hash)
+    if not mxc:
+        mxc = await user_api.upload_media(data=data, mime_type=mime_type, filename=filename)
+        await run_in_store_thread(remember_uploaded_media, contents_hash, mxc)
+    return mxc
+
+
+async def upload_file_cached(user_api: IntentAPI, filename, mime_type, name) -> str:
+    """
+    Uploads a file from disk, streaming it so that only a small piece of it is in
+    memory at any time, and reusing the previous upload if these exact contents
+    have already been uploaded. `name` is the file name to show. Returns the mxc URI.
+    """
+    contents_hash = await asyncio.to_thread(hash_file, filename)
+    mxc = await run_in_store_thread(get_uploaded_media, contents_hash)
+    if mxc:
+        return mxc
+    for attempt in range(UPLOAD_ATTEMPTS):
+        try:
+            # The file is read as it is sent, so every attempt needs to read it again
+            mxc = await user_api.upload_media(
+                data=read_file_in_chunks(filename),
+                mime_type=mime_type,
+                filename=name,
+                size=os.path.getsize(filename),
+            )
+            break
+        except (MatrixRequestError, MatrixConnectionError) as e:
+            if attempt == UPLOAD_ATTEMPTS - 1 or not _is_retryable(e):
+                raise
+            await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+    await run_in_store_thread(remember_uploaded_media, contents_hash, mxc)
+    return mxc
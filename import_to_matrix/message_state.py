@@ -1,8 +1,13 @@
-from sqlitedict import SqliteDict
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+from collections import OrderedDict
+from typing import Literal
+from import_to_matrix.store import DB_FILE, Store, Table, get_store, run_in_store_thread
+from config import config
 
-DB_FILE = "db.sqlite"
-
-# We don't want any serialization from sqlitedict
+# We don't want any serialization (values are stored as strings)
 
 def _encode(str: str):
     return str.encode()
@@ -18,6 +23,105 @@ def _encode_list(items: list[str]) -> bytes:
 def _decode_list(obj: bytes) -> list[str]:
     return obj.decode().split(',')
 
+# Mapping between Matrix events and Mattermost posts: one row per Matrix event.
+# role is what the event is for (see `EventRole`), and ordinal is its position
+# among the events of the same post
+EVENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    post_id TEXT NOT NULL,
+    room_id TEXT,
+    role TEXT NOT NULL,
+    ordinal INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_post ON events (post_id, ordinal);
+CREATE INDEX IF NOT EXISTS events_by_room ON events (room_id);
+"""
+
+# What a Matrix event is for: the text of a post, one of its files, or one
+# of its Slack attachments
+EventRole = Literal['text', 'media', 'attachment']
+
+# Key-value tables used before the events table existed
+_OLD_EVENT_TABLES = ('mm2matrix', 'mm2matrixtext', 'mm2matrixfulllist', 'matrix2mm')
+
+def _migrate_event_tables(store: Store):
+    """
+    Move the event mapping from the old key-value tables (if any) into the events table,
+    and delete them. The room is unknown, and files cannot be told apart from Slack
+    attachments, so every non-text event becomes 'media'.
+    """
+    tables = {name for name, in store.fetchall("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not tables.issuperset(_OLD_EVENT_TABLES):
+        return
+    print('Migrating the event mapping in', DB_FILE)
+    text_events = dict(store.table('mm2matrixtext', _encode, _decode).items())
+    event_lists = dict(store.table('mm2matrixfulllist', _encode_list, _decode_list).items())
+    rows = []
+    for post_id, event_ids in event_lists.items():
+        for ordinal, event_id in enumerate(event_ids):
+            role = 'text' if event_id == text_events.get(post_id) else 'media'
+            rows.append((event_id, post_id, None, role, ordinal))
+    # Posts bridged from Matrix only have their one event in mm2matrix
+    for post_id, event_id in store.table('mm2matrix', _encode, _decode).items():
+        if post_id not in event_lists:
+            rows.append((event_id, post_id, None, 'text', 0))
+    store.write_many('INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?)', rows)
+    for name in _OLD_EVENT_TABLES:
+        store.write(f'DROP TABLE "{name}"')
+    store.commit()
+
+
+class LRUCache:
+    """
+    Dictionary-like cache that only keeps the `size` most recently used entries,
+    and counts how many lookups found what they were looking for
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # (`AsyncMessageState` uses it from two threads)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def peek(self, key):
+        """
+        Like `get`, but a miss is not counted, for when the caller is going to
+        look it up with `get` anyway
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class MessageState:
     """
     some state to deal with importing messages
@@ -25,131 +129,135 @@ class MessageState:
 
     # the most recent message in a given thread, as a mattermost
     # message ID, because mattermost only keeps track of the root
-    _most_recent_message_in_thread: SqliteDict
-    
-    # mapping from mattermost message ID to matrix event ID
-    # (last message event: this is used generally)
-    _matrix_event_id: SqliteDict
+    _most_recent_message_in_thread: Table
 
-    # The following 2 databases exist only because Matrix currently
-    # does not have a way of sending a single message with attachments,
-    # and instead they are sent separately
-    # (https://github.com/matrix-org/matrix-spec/issues/541,
-    #  https://github.com/matrix-org/matrix-spec/issues/242)
+    # mapping from mattermost channel ID to the last message imported into it,
+    # as "post ID,create_at", to be able to resume imports
+    _checkpoints: Table
 
-    # mapping from mattermost message ID to matrix event ID
-    # (only text messages: this is used for bridging message edits)
-    _matrix_text_event_id: SqliteDict
+    # The results of recent lookups and writes, since almost every lookup is
+    # about a recent message (keyed by (kind of lookup, ID))
+    cache: LRUCache
 
-    # mapping from mattermost message ID to matrix event ID
-    # (full list of events: this is used for bridging message deletions)
-    _matrix_event_id_list: SqliteDict
+    def __init__(self):
+        self.cache = LRUCache(config.matrix.state_cache_size)
+        self._store = get_store()
+        self._most_recent_message_in_thread = self._store.table("thread", _encode, _decode)
+        self._checkpoints = self._store.table("checkpoints", _encode_list, _decode_list)
+        # (the mapping between Matrix events and Mattermost posts is in the events table)
+        for statement in EVENTS_SCHEMA.split(';'):
+            self._store.execute(statement)
+        _migrate_event_tables(self._store)
 
-    # mapping from matrix event ID to mattermost message ID
-    _mattermost_message_id: SqliteDict
+    def _cached(self, kind, key, lookup):
+        """
+        Get the result of a lookup from the cache, or do the lookup and cache it
+        (only if something was found, since it may be written later)
+        """
+        value = self.cache.get((kind, key))
+        if value is None:
+            value = lookup()
+            if value is not None:
+                self.cache[kind, key] = value
+        return value
 
-    def __init__(self):
-        self.db = SqliteDict(DB_FILE)
-        self._most_recent_message_in_thread = SqliteDict(
-            DB_FILE,
-            tablename="thread",
-            autocommit=True,
-            encode=_encode,
-            decode=_decode,
-        )
-        self._matrix_event_id = SqliteDict(
-            DB_FILE,
-            tablename="mm2matrix",
-            autocommit=True,
-            encode=_encode,
-            decode=_decode,
-        )
-        self._matrix_text_event_id = SqliteDict(
-            DB_FILE,
-            tablename="mm2matrixtext",
-            autocommit=True,
-            encode=_encode,
-            decode=_decode,
-        )
-        self._matrix_event_id_list = SqliteDict(
-            DB_FILE,
-            tablename="mm2matrixfulllist",
-            autocommit=True,
-            encode=_encode_list,
-            decode=_decode_list,
-        )
-        self._mattermost_message_id = SqliteDict(
-            DB_FILE,
-            tablename="matrix2mm",
-            autocommit=True,
-            encode=_encode,
-            decode=_decode,
-        )
+    # Matrix does not currently have a way of sending a single message with
+    # attachments, so attachments are sent separately, and a Mattermost post
+    # may have several Matrix events
+    # (https://github.com/matrix-org/matrix-spec/issues/541,
+    #  https://github.com/matrix-org/matrix-spec/issues/242)
 
     def get_matrix_event(self, mattermost_id):
         """
         Get the Matrix ID of the message corresponding to the given Mattermost
-        message ID. Returns None if we can't remember this Mattermost event ID,
-        otherwise returns the Matrix event ID.
+        message ID (its last event, if there are several). Returns None if we
+        can't remember this Mattermost event ID, otherwise returns the Matrix event ID.
         """
-        if mattermost_id not in self._matrix_event_id:
-            return None
-        return self._matrix_event_id[mattermost_id]
-    
+        def lookup():
+            row = self._store.fetchone(
+                'SELECT event_id FROM events WHERE post_id = ? ORDER BY ordinal DESC LIMIT 1',
+                (mattermost_id,),
+            )
+            return row[0] if row else None
+        return self._cached('event', mattermost_id, lookup)
+
     def get_matrix_text_event(self, mattermost_id):
         """
         Returns the Matrix ID of the *text* message corresponding to the given
-        Mattermost message ID. Returns None if the Mattermost ID does not
-        correspond to any text message on Matrix.
+        Mattermost message ID (used for bridging message edits). Returns None if
+        the Mattermost ID does not correspond to any text message on Matrix.
         """
-        if mattermost_id not in self._matrix_text_event_id:
-            return None
-        return self._matrix_text_event_id[mattermost_id]
-    
+        def lookup():
+            row = self._store.fetchone(
+                "SELECT event_id FROM events WHERE post_id = ? AND role = 'text' LIMIT 1",
+                (mattermost_id,),
+            )
+            return row[0] if row else None
+        return self._cached('text', mattermost_id, lookup)
+
     def get_matrix_full_event_list(self, mattermost_id):
         """
         Returns the full list of Matrix event IDs corresponding to the
-        given Mattermost post ID, or None if not found.
+        given Mattermost post ID (used for bridging message deletions),
+        or None if not found.
         """
-        if mattermost_id not in self._matrix_event_id_list:
-            return None
-        return self._matrix_event_id_list[mattermost_id]
+        def lookup():
+            rows = self._store.fetchall(
+                'SELECT event_id FROM events WHERE post_id = ? ORDER BY ordinal',
+                (mattermost_id,),
+            )
+            return [event_id for event_id, in rows] or None
+        return self._cached('list', mattermost_id, lookup)
+
+    def get_room_events(self, room_id) -> list[tuple[str, str]]:
+        """
+        Returns (Matrix event ID, Mattermost post ID) for every event we know of
+        in the given room
+        """
+        return self._store.fetchall(
+            'SELECT event_id, post_id FROM events WHERE room_id = ?',
+            (room_id,),
+        )
     
     def get_mattermost_event(self, matrix_id):
         """
         Returns the Mattermost message ID of the message with given Matrix ID,
         otherwise None if it can't be found
         """
-        if matrix_id not in self._mattermost_message_id:
-            return None
-        return self._mattermost_message_id[matrix_id]
+        def lookup():
+            row = self._store.fetchone(
+                'SELECT post_id FROM events WHERE event_id = ?',
+                (matrix_id,),
+            )
+            return row[0] if row else None
+        return self._cached('post', matrix_id, lookup)
 
-    def remember_matrix_event(self, mattermost_id, matrix_id):
+    def remember_matrix_events(self, mattermost_id, room_id, events: list[tuple[str, EventRole]]):
         """
-        Remembers that the event with mattermost_id on Mattermost was bridged
-        to the event with matrix_id on Matrix (or maybe vice versa).
+        Remembers that the post with mattermost_id on Mattermost was bridged
+        to the given Matrix events (event ID, role), in order, in the given room
         """
-        assert mattermost_id not in self._matrix_event_id, 'did you bridge this twice?'
-        self._matrix_event_id[mattermost_id] = matrix_id
-        self._mattermost_message_id[matrix_id] = mattermost_id
+        assert self.get_matrix_event(mattermost_id) is None, 'did you bridge this twice?'
+        self._store.write_many('INSERT INTO events VALUES (?, ?, ?, ?, ?)', [
+            (event_id, mattermost_id, room_id, role, ordinal)
+            for ordinal, (event_id, role) in enumerate(events)
+        ])
+        # This is most likely what we will be asked about next
+        event_ids = [event_id for event_id, _ in events]
+        self.cache['event', mattermost_id] = event_ids[-1]
+        self.cache['list', mattermost_id] = event_ids
+        for event_id in event_ids:
+            self.cache['post', event_id] = mattermost_id
+        text_event_ids = [event_id for event_id, role in events if role == 'text']
+        if text_event_ids:
+            self.cache['text', mattermost_id] = text_event_ids[0]
 
-    def remember_matrix_text_event(self, mattermost_id, matrix_id):
+    def remember_matrix_event(self, mattermost_id, matrix_id, room_id=None, role: EventRole = 'text'):
         """
         Remembers that the event with mattermost_id on Mattermost was bridged
-        to the event with matrix_id on Matrix, and that such event is a text message.
-        
-        (This is needed because Matrix does not support sending messages with attachments,
-        so attachments are sent on a separate message each, meaning there is not really
-        a one-to-one relationship between mattermost post IDs and Matrix event IDs)
-        """
-        self._matrix_text_event_id[mattermost_id] = matrix_id
-        self._mattermost_message_id[matrix_id] = mattermost_id
-
-    def set_matrix_event_list(self, mattermost_id, event_ids: list[str]):
-        """
-        Sets the Matrix event ID list corresponding to the given mattermost ID
+        to the event with matrix_id on Matrix (or maybe vice versa).
         """
-        self._matrix_event_id_list[mattermost_id] = event_ids
+        self.remember_matrix_events(mattermost_id, room_id, [(matrix_id, role)])
 
     def get_most_recent_message_in_thread(self, root_mattermost_id):
         """
@@ -158,13 +266,94 @@ class MessageState:
         """
         # this might be too much of a hassle to have with the bridge,
         # which is why I might just set it to work with threads to threads
-        if root_mattermost_id not in self._most_recent_message_in_thread:
-            return None
-        return self._most_recent_message_in_thread[root_mattermost_id]
+        return self._cached('thread', root_mattermost_id, lambda: self._most_recent_message_in_thread.get(root_mattermost_id))
     
     def set_most_recent_message_in_thread(self, root_mattermost_id, mattermost_id):
         """
         Remembers that the most recent message in the thread with ID root_mattermost_id
         on Mattermost is mattermost_id on Mattermost.
         """
-        self._most_recent_message_in_thread[root_mattermost_id] = mattermost_id
\ No newline at end of file
+        self._most_recent_message_in_thread[root_mattermost_id] = mattermost_id
+        self.cache['thread', root_mattermost_id] = mattermost_id
+
+    def get_checkpoint(self, channel_id) -> tuple[str, int] | None:
+        """
+        Returns the Mattermost post ID and creation time of the last message imported
+        into the given Mattermost channel, or None if nothing has been imported
+        """
+        checkpoint = self._checkpoints.get(channel_id)
+        if checkpoint is None:
+            return None
+        post_id, create_at = checkpoint
+        return post_id, int(create_at)
+
+    def set_checkpoint(self, channel_id, post_id, create_at):
+        """
+        Remembers that every message in the Mattermost channel up to (and including)
+        the given post has been imported
+        """
+        self._checkpoints[channel_id] = [post_id, str(create_at)]
+
+
+class AsyncMessageState:
+    """
+    Same as `MessageState`, but awaitable, for use from asyncio code: the database
+    is accessed from another thread, so the event loop can keep handling other
+    events meanwhile. Lookups that are in the cache are answered right away.
+    """
+
+    # The MessageState doing the work (which may also be used directly)
+    sync: MessageState
+
+    def __init__(self, state: MessageState = None):
+        self.sync = state or MessageState()
+
+    async def _run(self, method, *args, **kwargs):
+        return await run_in_store_thread(method, *args, **kwargs)
+
+    async def _lookup(self, kind, key, method):
+        # Nothing is ever stored under an empty ID
+        if not key:
+            return None
+        # Checked and read in one step, since the database thread may be changing the cache
+        value = self.sync.cache.peek((kind, key))
+        if value is not None:
+            return value
+        return await self._run(method, key)
+
+    @property
+    def cache(self) -> LRUCache:
+        return self.sync.cache
+
+    async def get_matrix_event(self, mattermost_id):
+        return await self._lookup('event', mattermost_id, self.sync.get_matrix_event)
+
+    async def get_matrix_text_event(self, mattermost_id):
+        return await self._lookup('text', mattermost_id, self.sync.get_matrix_text_event)
+
+    async def get_matrix_full_event_list(self, mattermost_id):
+        return await self._lookup('list', mattermost_id, self.sync.get_matrix_full_event_list)
+
+    async def get_mattermost_event(self, matrix_id):
+        return await self._lookup('post', matrix_id, self.sync.get_mattermost_event)
+
+    async def get_most_recent_message_in_thread(self, root_mattermost_id):
+        return await self._lookup('thread', root_mattermost_id, self.sync.get_most_recent_message_in_thread)
+
+    async def get_room_events(self, room_id):
+        return await self._run(self.sync.get_room_events, room_id)
+
+    async def remember_matrix_events(self, mattermost_id, room_id, events: list[tuple[str, EventRole]]):
+        await self._run(self.sync.remember_matrix_events, mattermost_id, room_id, events)
+
+    async def remember_matrix_event(self, mattermost_id, matrix_id, room_id=None, role: EventRole = 'text'):
+        await self._run(self.sync.remember_matrix_event, mattermost_id, matrix_id, room_id, role)
+
+    async def set_most_recent_message_in_thread(self, root_mattermost_id, mattermost_id):
+        await self._run(self.sync.set_most_recent_message_in_thread, root_mattermost_id, mattermost_id)
+
+    async def get_checkpoint(self, channel_id) -> tuple[str, int] | None:
+        return await self._run(self.sync.get_checkpoint, channel_id)
+
+    async def set_checkpoint(self, channel_id, post_id, create_at):
+        await self._run(self.sync.set_checkpoint, channel_id, post_id, create_at)
@@ -4,13 +4,62 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from import_to_matrix.matrix import get_app_service
 from mautrix.api import Method, Path
 from mautrix.appservice import IntentAPI
+from mautrix.types import EventType
 import mautrix.errors
 
+# Room ID -> (MXID -> membership) for the rooms we have touched, so that we only
+# send membership events that actually change something. Each room is loaded from
+# its state once, and then kept up to date as we change memberships.
+_memberships: dict[str, dict[str, str]] = {}
+
+async def get_memberships(room_id) -> dict[str, str]:
+    """
+    Get the membership (join, invite, leave...) of everyone in the given room ID
+    """
+    if room_id not in _memberships:
+        app_service = get_app_service()
+        api = app_service.bot_intent()
+        members = await api.get_members(room_id)
+        # (another call may have loaded it while we were waiting)
+        _memberships.setdefault(room_id, {
+            member.state_key: str(member.content.membership)
+            for member in members
+        })
+    return _memberships[room_id]
+
+
+async def get_membership(room_id, user_id) -> str | None:
+    """
+    Get the membership of the user in the given room ID,
+    or None if they have never been in the room
+    """
+    return (await get_memberships(room_id)).get(user_id)
+
+
+async def remember_membership(room_id, user_id, membership: str):
+    """
+    Remember that we changed the membership of the user in the given room ID
+    """
+    (await get_memberships(room_id))[user_id] = str(membership)
+
+
+def update_membership(room_id, user_id, membership: str):
+    """
+    Keep up with a membership change made by someone else (e.g. a kick), seen in
+    an m.room.member event. Rooms we have not loaded yet are left alone, since
+    they are loaded from their current state anyway.
+    """
+    if room_id in _memberships:
+        _memberships[room_id][user_id] = str(membership)
+
+
 async def join_user_to_room(user_id, room_id, timestamp):
     """
-    Join the user to the given room ID/alias
-    at the specified time
+    Join the user to the given room ID
+    at the specified time (unless they are already in the room)
     """
+    if await get_membership(room_id, user_id) == 'join':
+        return
     # Works around https://github.com/mautrix/python/issues/151
     # In practice, mautrix accepts timestamp for leave events but not join events
     app_service = get_app_service()
@@ -23,21 +72,110 @@ async def join_user_to_room(user_id, room_id, timestamp):
             content={'membership': 'join'},
         )
     except mautrix.errors.request.MForbidden as e:
-        # swallow "is already in the room." errors
-        pass
+        # swallow "is already in the room." errors, but nothing else
+        if 'already in the room' not in (e.message or ''):
+            raise
+    await remember_membership(room_id, user_id, 'join')
+
+# Room ID -> pinned Matrix event IDs, for the rooms we have pinned something in,
+# so that we don't need to ask for the whole list on every pin
+_pinned_events: dict[str, list[str]] = {}
+
+async def get_pinned_events(user_api: IntentAPI, room_id) -> list[str]:
+    """
+    Get the pinned event IDs in the given room (only asking the homeserver once per room)
+    """
+    if room_id not in _pinned_events:
+        _pinned_events[room_id] = await user_api.get_pinned_messages(room_id)
+    return _pinned_events[room_id]
+
+
+def remember_pinned_events(room_id, event_ids: list[str]):
+    """
+    Remember the pinned event IDs of a room, after seeing them change
+    """
+    _pinned_events[room_id] = list(event_ids)
+
 
 # TODO (very easy): contribute to mautrix so this allows timestamp
 # all you need is to add *kwargs to pin_message
-async def pin_message(user_api: IntentAPI, room_id, event_id, timestamp):
+async def pin_message(user_api: IntentAPI, room_id, event_id, timestamp=None):
     """
     pin_message but it supports timestamp massaging
     """
     # copied and pasted from pin_message in intent.py except I actually pass
     # in the timestamp
-    events = await user_api.get_pinned_messages(room_id)
+    events = await get_pinned_events(user_api, room_id)
     if event_id not in events:
+        await user_api.set_pinned_messages(room_id, events + [event_id], timestamp=timestamp)
         events.append(event_id)
-        await user_api.set_pinned_messages(room_id, events, timestamp=timestamp)
+
+
+class DeferredPins:
+    """
+    Collects the pins of a room during backfill, to set the pinned events once
+    (or once every `flush_every` pins), instead of once per pin.
+    """
+
+    # How many pins to collect at most before setting them
+    flush_every: int
+
+    # (user API of who pinned it, event ID, timestamp) for every pin not set yet
+    _pending: list[tuple[IntentAPI, str, int]]
+
+    def __init__(self, room_id, flush_every=100):
+        self.room_id = room_id
+        self.flush_every = flush_every
+        self._pending = []
+
+    async def pin_message(self, user_api: IntentAPI, event_id, timestamp):
+        """
+        Pin the given event, now or later
+        """
+        self._pending.append((user_api, event_id, timestamp))
+        if len(self._pending) >= self.flush_every:
+            await self.flush()
+
+    async def flush(self):
+        """
+        Set every pending pin, as whoever pinned the last one, when they pinned it
+        """
+        if not self._pending:
+            return
+        user_api, _, timestamp = self._pending[-1]
+        events = await get_pinned_events(user_api, self.room_id)
+        new_events = [event_id for _, event_id, _ in self._pending if event_id not in events]
+        if new_events:
+            await user_api.set_pinned_messages(self.room_id, events + new_events, timestamp=timestamp)
+            events.extend(new_events)
+        self._pending = []
+
+
+# Space room ID -> room IDs of its children, for the spaces we have touched
+_space_children: dict[str, set[str]] = {}
+
+async def get_space_children(space_id) -> set[str]:
+    """
+    Get the room IDs of the children of the given space (only asking the homeserver once per space)
+    """
+    if space_id not in _space_children:
+        app_service = get_app_service()
+        api = app_service.bot_intent()
+        state = await api.get_state(space_id)
+        # (removed children have their state event emptied)
+        _space_children.setdefault(space_id, {
+            event.state_key
+            for event in state
+            if event.type == EventType.SPACE_CHILD and getattr(event.content, 'via', None)
+        })
+    return _space_children[space_id]
+
+
+async def remember_space_child(space_id, room_id):
+    """
+    Remember that we added the given room ID to the given space
+    """
+    (await get_space_children(space_id)).add(room_id)
 
 
 class MessageReaction:
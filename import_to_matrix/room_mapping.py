@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from import_to_matrix.store import get_store, run_in_store_thread
+from import_to_matrix.message_state import _encode, _decode
+
+# Mattermost channel ID -> Matrix room ID, and back, for every channel we have a room for
+_rooms = get_store().table("channel2room", _encode, _decode)
+_channels = get_store().table("room2channel", _encode, _decode)
+
+# The same, in memory, so that the bridge does not touch the database on every event
+_room_ids: dict[str, str] = dict(_rooms.items())
+_channel_ids: dict[str, str] = dict(_channels.items())
+
+def get_room_for_channel(channel_id) -> str | None:
+    """
+    Get the Matrix room ID of the given Mattermost channel ID,
+    or None if we don't know of a room for it
+    """
+    return _room_ids.get(channel_id)
+
+
+def get_channel_for_room(room_id) -> str | None:
+    """
+    Get the Mattermost channel ID of the given Matrix room ID,
+    or None if we don't know of a channel for it
+    """
+    return _channel_ids.get(room_id)
+
+
+def _save_channel_room(channel_id, room_id):
+    _rooms[channel_id] = room_id
+    _channels[room_id] = channel_id
+
+
+async def remember_channel_room(channel_id, room_id):
+    """
+    Remember that the given Mattermost channel ID is bridged to the given Matrix room ID
+    """
+    if _room_ids.get(channel_id) == room_id and _channel_ids.get(room_id) == channel_id:
+        return
+    _room_ids[channel_id] = room_id
+    _channel_ids[room_id] = channel_id
+    await run_in_store_thread(_save_channel_room, channel_id, room_id)
@@ -0,0 +1,180 @@
+import asyncio
+import atexit
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import config
+
+DB_FILE = "db.sqlite"
+
+class Table:
+    """
+    Dictionary-like key -> value table in a `Store`. It uses the same format
+    as SqliteDict (key TEXT PRIMARY KEY, value BLOB), so tables written by
+    previous versions can still be read.
+    """
+
+    def __init__(self, store: 'Store', name, encode, decode):
+        self._store = store
+        self.name = name
+        self._encode = encode
+        self._decode = decode
+        store.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (key TEXT PRIMARY KEY, value BLOB)')
+
+    def get(self, key, default=None):
+        row = self._store.fetchone(f'SELECT value FROM "{self.name}" WHERE key = ?', (key,))
+        if row is None:
+            return default
+        return self._decode(row[0])
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._store.fetchone(f'SELECT 1 FROM "{self.name}" WHERE key = ?', (key,)) is not None
+
+    def __setitem__(self, key, value):
+        self._store.write(f'REPLACE INTO "{self.name}" (key, value) VALUES (?, ?)', (key, self._encode(value)))
+
+    def __delitem__(self, key):
+        self._store.write(f'DELETE FROM "{self.name}" WHERE key = ?', (key,))
+
+    def items(self):
+        for key, value in self._store.fetchall(f'SELECT key, value FROM "{self.name}"'):
+            yield key, self._decode(value)
+
+
+class Store:
+    """
+    All of our state in db.sqlite, over a single connection in WAL mode.
+
+    Writes are committed together, once `commit_every` writes are pending or
+    `commit_interval_ms` milliseconds after the first one, whichever comes first
+    (and when the program exits), instead of one transaction per write. If the
+    program crashes, the writes of the last few moments may be lost.
+    """
+
+    def __init__(self, filename=DB_FILE, commit_every=100, commit_interval_ms=500):
+        self.commit_every = commit_every
+        self.commit_interval_ms = commit_interval_ms
+        # Used from the commit timer too, but never at the same time
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # Safe in WAL mode: a crash may lose the last commits, but never corrupts the database
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._pending_writes = 0
+        self._timer: threading.Timer | None = None
+
+    def table(self, name, encode, decode) -> Table:
+        """
+        Get the table with the given name (creating it if needed), whose values
+        are converted to and from bytes with the given functions
+        """
+        return Table(self, name, encode, decode)
+
+    def execute(self, sql, parameters=()):
+        """
+        Run a query that does not modify anything (nor return anything)
+        """
+        with self._lock:
+            self._connection.execute(sql, parameters)
+
+    def fetchone(self, sql, parameters=()) -> tuple | None:
+        """
+        Run a query and return its first row, or None if there is none
+        """
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchone()
+
+    def fetchall(self, sql, parameters=()) -> list[tuple]:
+        """
+        Run a query and return all of its rows
+        """
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def write(self, sql, parameters=()):
+        """
+        Run a query that modifies the database, committing it later
+        """
+        with self._lock:
+            self._connection.execute(sql, parameters)
+            self._wrote()
+
+    def write_many(self, sql, rows):
+        """
+        Run a query that modifies the database once for each of the given rows,
+        committing it later
+        """
+        with self._lock:
+            self._connection.executemany(sql, rows)
+            self._wrote()
+
+    def _wrote(self):
+        """
+        Commit now if enough writes are pending, or make sure we commit soon otherwise
+        """
+        self._pending_writes += 1
+        if self._pending_writes >= self.commit_every:
+            self.commit()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.commit_interval_ms / 1000, self.commit)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def commit(self):
+        """
+        Commit every pending write right away
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending_writes:
+                self._connection.commit()
+                self._pending_writes = 0
+
+    def close(self):
+        """
+        Commit every pending write and close the database
+        """
+        with self._lock:
+            self.commit()
+            self._connection.close()
+
+
+# Let only one instance exist, so everything shares the same connection
+__store: Store = None
+
+def get_store() -> Store:
+    """
+    Opens the database, if it has not been opened yet, and returns it
+    """
+    global __store
+    if __store is None:
+        __store = Store(
+            commit_every=config.matrix.db_commit_every,
+            commit_interval_ms=config.matrix.db_commit_interval_ms,
+        )
+        atexit.register(__store.commit)
+    return __store
+
+
+# The only thread asyncio code touches the database from, so that the event loop
+# never waits for it (e.g. while the commit timer holds the lock), and database
+# access never happens concurrently
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+
+async def run_in_store_thread(function, *args, **kwargs):
+    """
+    Call the given function (which uses the database) in the database thread
+    and wait for its result, without blocking the event loop
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, lambda: function(*args, **kwargs))
@@ -1,8 +1,11 @@
+from dataclasses import dataclass
 from mautrix.appservice import IntentAPI
+from mautrix.types import EventType
 import mautrix.errors
-from mattermost import MMApi
+from export_from_mattermost.async_api import AsyncMMApi
 from import_to_matrix.matrix import get_app_service
 from import_to_matrix.not_in_mautrix import get_room_aliases
+from import_to_matrix.room_mapping import get_channel_for_room, remember_channel_room
 from config import config
 
 def is_bridged_user(mxid: str) -> bool:
@@ -14,11 +17,26 @@ def is_bridged_user(mxid: str) -> bool:
         and localpart.startswith(config.matrix.user_prefix)
 
 
-async def matrix_to_mattermost_channel(mm_api: MMApi, matrix_api: IntentAPI, room_id: str) -> str:
+async def matrix_to_mattermost_channel(mm_api: AsyncMMApi, matrix_api: IntentAPI, room_id: str) -> str:
     """
     Given a Matrix room ID, get a Mattermost channel ID.
     Returns None if it could not be found.
     """
+    # Try the rooms we already know about first
+    channel_id = get_channel_for_room(room_id)
+    if channel_id:
+        return channel_id
+    channel_id = await find_mattermost_channel(mm_api, matrix_api, room_id)
+    if channel_id:
+        await remember_channel_room(channel_id, room_id)
+    return channel_id
+
+
+async def find_mattermost_channel(mm_api: AsyncMMApi, matrix_api: IntentAPI, room_id: str) -> str:
+    """
+    Given a Matrix room ID, find its Mattermost channel ID by looking at the room.
+    Returns None if it could not be found.
+    """
     # Try using a custom state event first
     try:
         custom_state = await matrix_api.get_state_event(room_id, 'edu.mit.sipb.mattermost')
@@ -31,9 +49,9 @@ async def matrix_to_mattermost_channel(mm_api: MMApi, matrix_api: IntentAPI, roo
             if localpart.startswith(config.matrix.room_prefix) and homeserver == config.matrix.homeserver:
                 team_name, channel_name = localpart[len(config.matrix.room_prefix):].split('_')
                 # I could've used the downloaded files, but I'd rather ask Mattermost
-                teams = mm_api.get_teams()
+                teams = await mm_api.get_teams()
                 team = [team for team in teams if team['name'] == team_name][0]
-                channel = mm_api.get_channel_by_name(team['id'], channel_name)
+                channel = await mm_api.get_channel_by_name(team['id'], channel_name)
                 return channel['id']
 
 
@@ -49,6 +67,55 @@ def localpart_or_full_mxid(mxid):
         return mxid
     
 
+@dataclass
+class MemberProfile:
+    """
+    What we need from a Matrix room member to impersonate them on Mattermost
+    """
+    display_name: str | None
+    # Thumbnail of their avatar, ready to be used as `override_icon_url`
+    icon_url: str | None
+
+
+# (room ID, MXID) -> room profile of the member, kept up to date with the
+# m.room.member events we receive, so we don't ask the homeserver on every message
+_member_profiles: dict[tuple[str, str], MemberProfile] = {}
+
+def remember_member_profile(matrix_api: IntentAPI, room_id, mxid, display_name, avatar_mxc):
+    """
+    Remember the display name and avatar of the given member in the given room
+    """
+    icon_url = None
+    if avatar_mxc:
+        icon_url = str(matrix_api.api.get_download_url(
+            avatar_mxc,
+            download_type='thumbnail'
+        )) + '?width=128&height=128'
+    _member_profiles[room_id, mxid] = MemberProfile(display_name, icon_url)
+
+
+def forget_member_profile(room_id, mxid):
+    """
+    Forget the profile of the given member in the given room (e.g. once they leave)
+    """
+    _member_profiles.pop((room_id, mxid), None)
+
+
+async def get_member_profile(matrix_api: IntentAPI, room_id, mxid) -> MemberProfile:
+    """
+    Get the display name and avatar of the given member in the given room,
+    only asking the homeserver the first time
+    """
+    if (room_id, mxid) not in _member_profiles:
+        try:
+            member = await matrix_api.get_state_event(room_id, EventType.ROOM_MEMBER, mxid)
+            display_name, avatar_mxc = member.displayname, member.avatar_url
+        except mautrix.errors.MatrixError:
+            display_name, avatar_mxc = None, None
+        remember_member_profile(matrix_api, room_id, mxid, display_name, avatar_mxc)
+    return _member_profiles[room_id, mxid]
+
+
 async def get_mattermost_fake_user(matrix_api: IntentAPI, mxid, room_id, channel_id):
     """
     Given a Matrix MXID, get the Mattermost props
@@ -68,34 +135,25 @@ async def get_mattermost_fake_user(matrix_api: IntentAPI, mxid, room_id, channel
     if channel_id in config.mattermost.bridge.ignore_users_whitelist:
         del props['from_bot']
 
+    profile = await get_member_profile(matrix_api, room_id, mxid)
     # override profile picture
-    avatar_mxc = await matrix_api.get_room_avatar_url(room_id, mxid)
-    if avatar_mxc:
-        props['override_icon_url'] = str(matrix_api.api.get_download_url(
-            avatar_mxc,
-            download_type='thumbnail'
-        )) + '?width=128&height=128'
+    if profile.icon_url:
+        props['override_icon_url'] = profile.icon_url
     # (attempt to) override display name
-    try:
-        display_name = await matrix_api.get_room_displayname(room_id, mxid)
-    except:
-        display_name = None
-    if display_name:
-        props['webhook_display_name'] = display_name
+    if profile.display_name:
+        props['webhook_display_name'] = profile.display_name
     return props
     
 
-# TODO: contribute these 2 functoins upstream to the Mattermost API
-
-def pin_mattermost_message(mm_api: MMApi, post_id):
+async def pin_mattermost_message(mm_api: AsyncMMApi, post_id):
     """
     Pins a Mattermost message by post ID
     """
-    mm_api._post(f'/v4/posts/{post_id}/pin')
+    await mm_api.pin_post(post_id)
 
 
-def unpin_mattermost_message(mm_api: MMApi, post_id):
+async def unpin_mattermost_message(mm_api: AsyncMMApi, post_id):
     """
     Unpins the Mattermost message by post ID
     """
-    mm_api._post(f'/v4/posts/{post_id}/unpin')
\ No newline at end of file
+    await mm_api.unpin_post(post_id)
\ No newline at end of file